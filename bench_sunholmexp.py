@@ -0,0 +1,343 @@
+################################################################################
+# Times how sunholmexp.py scales by replaying the shipped exp_events.json and
+# synthetic campaigns of increasing size, and saves the timings as json so that
+# they can be compared between versions.
+# bench_sunholmexp.py [--sessions N ...] [--output FILE] [--compare FILE]
+################################################################################
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+import sunholmexp
+from level_table import level_exp_caps, get_level_from_exp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+################################################################################
+# CampaignConfig
+#
+# The shape of a synthetic campaign. The ratios are the chance of each session
+# using a % based exp grant, of each attending player writing a quest log, and
+# of a player leaving or returning between sessions.
+################################################################################
+@dataclass
+class CampaignConfig:
+    players: int = 40
+    sessions: int = 1000
+    percent_ratio: float = 0.3
+    questlog_ratio: float = 0.4
+    churn: float = 0.05
+    seed: str = "sunholm"
+
+
+################################################################################
+# generate_campaign
+#
+# Creates the events of a synthetic campaign in chronological order. Players
+# are added, removed and restored between sessions, and each session is
+# attended by a handful of the active players, some of whom wrote quest logs.
+################################################################################
+def generate_campaign(config: CampaignConfig) -> List[Any]:
+    rng = random.Random(config.seed)
+    date = datetime.datetime(2021, 1, 1, 18, 0, 0)
+    events: List[Any] = []
+
+    def add(event: Any) -> None:
+        nonlocal date
+        date += datetime.timedelta(seconds=rng.randint(1, 7 * 24 * 60 * 60))
+        event["date"] = date.strftime('%Y/%m/%d-%H:%M:%S')
+        events.append(event)
+
+    active: List[str] = []
+    removed: List[str] = []
+    player_count = 0
+
+    def new_player() -> None:
+        nonlocal player_count
+        player_count += 1
+        name = "Player{n}".format(n=player_count)
+        active.append(name)
+        add({
+            "type": "newplayer",
+            "name": name,
+            "exp": level_exp_caps[rng.randint(1, 4)],
+        })
+
+    for _ in range(config.players):
+        new_player()
+
+    for _ in range(config.sessions):
+        if rng.random() < config.churn and len(active) > 8:
+            name = active.pop(rng.randrange(len(active)))
+            removed.append(name)
+            add({"type": "removeplayer", "name": name})
+        if rng.random() < config.churn and removed:
+            name = removed.pop(rng.randrange(len(removed)))
+            active.append(name)
+            add({"type": "restoreplayer", "name": name})
+        if rng.random() < config.churn:
+            new_player()
+        if rng.random() < config.churn:
+            add({"type": "bonusexp", "name": rng.choice(active), "bonusexp": rng.randint(100, 5000)})
+        if rng.random() < config.churn / 2:
+            add({
+                "type": "levelup",
+                "name": rng.choice(active),
+                "levels": 1,
+                "preserve_percentage": rng.random() < 0.5,
+            })
+
+        attending = rng.sample(active, min(len(active), rng.randint(3, 8)))
+        players: List[str] = []
+        questlog_players: List[str] = []
+        fastlog_players: List[str] = []
+        for name in attending:
+            if rng.random() < config.questlog_ratio:
+                rng.choice([questlog_players, fastlog_players]).append(name)
+            else:
+                players.append(name)
+
+        if rng.random() < config.percent_ratio:
+            exp_gained = "{percentage}%".format(percentage=rng.randint(5, 40))
+            if rng.random() < 0.5:
+                exp_gained += "+{exp}".format(exp=rng.randint(1, 20) * 500)
+        else:
+            exp_gained = str(rng.randint(1, 60) * 500)
+
+        add({
+            "type": "sessionexp",
+            "exp_gained": exp_gained,
+            "players": players,
+            "questlog_players": questlog_players,
+            "fastlog_players": fastlog_players,
+        })
+
+    return events
+
+
+################################################################################
+# write_event_source
+#
+# Writes events out the same way exp_events.json is stored, newest first.
+################################################################################
+def write_event_source(path: str, events: List[Any]) -> None:
+    with open(path, "w") as f:
+        json.dump(list(reversed(events)), f, indent=4)
+
+
+def clear_caches() -> None:
+    shutil.rmtree(sunholmexp.SNAPSHOT_DIR, ignore_errors=True)
+    shutil.rmtree(sunholmexp.TIMELINE_DIR, ignore_errors=True)
+    if os.path.exists(sunholmexp.EVENT_INDEX_FILE):
+        os.remove(sunholmexp.EVENT_INDEX_FILE)
+
+
+################################################################################
+# time_function
+#
+# Runs a function repeat times with its output discarded and returns how long
+# the runs took in seconds. setup is run before each run and is not timed.
+################################################################################
+def time_function(function: Callable[[], Any], repeat: int, setup: Callable[[], Any] = lambda: None) -> Dict[str, Any]:
+    runs: List[float] = []
+    for _ in range(repeat):
+        setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            runs.append(time.perf_counter() - start)
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+    }
+
+
+################################################################################
+# random_parties
+#
+# Creates parties of players at the levels found in a replayed state, for
+# timing divide_exp on its own.
+################################################################################
+def random_parties(state: sunholmexp.State, count: int) -> List[Any]:
+    rng = random.Random("divide_exp")
+    exp_values = list(state.players.values())
+    parties = []
+    for _ in range(count):
+        party_exp = rng.sample(exp_values, min(len(exp_values), rng.randint(3, 8)))
+        parties.append((rng.randint(1, 60) * 500, party_exp))
+    return parties
+
+
+def divide_parties(parties: List[Any]) -> None:
+    for total_exp, party_exp in parties:
+        sunholmexp.divide_exp(total_exp, [
+            sunholmexp.LevelingUpPlayer(name=str(i), exp=exp, level=get_level_from_exp(exp))
+            for i, exp in enumerate(party_exp)
+        ])
+
+
+################################################################################
+# benchmark_campaign
+#
+# Times the commands that replay events against a campaign, first from the
+# legacy newest-first json and then from the event log it is migrated to.
+################################################################################
+def benchmark_campaign(events: List[Any], repeat: int) -> Dict[str, Any]:
+    timings: Dict[str, Any] = {}
+
+    def replay_in_memory() -> None:
+        state = sunholmexp.State()
+        for event in events:
+            sunholmexp.process_event(event, state)
+
+    timings["process_events"] = time_function(replay_in_memory, repeat)
+
+    write_event_source(sunholmexp.EVENTSOURCE_FILE, events)
+    timings["cold_replay_json"] = time_function(sunholmexp.replay_to, repeat, setup=clear_caches)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        sunholmexp.migrate_event_source()
+    timings["cold_replay_log"] = time_function(sunholmexp.replay_to, repeat, setup=clear_caches)
+    timings["warm_replay_log"] = time_function(sunholmexp.replay_to, repeat)
+    timings["list"] = time_function(sunholmexp.list_current_state, repeat)
+    timings["last"] = time_function(sunholmexp.list_previous_update, repeat)
+
+    state, _ = sunholmexp.replay_to()
+    player_name = next(iter(state.players))
+
+    def append() -> None:
+        sunholmexp.add_bonus_exp_event(player_name=player_name, bonus_exp=1)
+        sunholmexp.show_last_update(None)
+
+    timings["incremental_append"] = time_function(append, repeat)
+
+    parties = random_parties(state, 1000)
+    timings["divide_exp_1000_parties"] = time_function(lambda: divide_parties(parties), repeat)
+
+    return timings
+
+
+################################################################################
+# run_in_temporary_directory
+#
+# sunholmexp reads and writes its files in the working directory, so each
+# campaign is benchmarked in its own temporary directory.
+################################################################################
+def run_in_temporary_directory(function: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    original_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            return function()
+        finally:
+            os.chdir(original_directory)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+################################################################################
+# print_comparison
+#
+# Prints how each timing changed relative to an earlier results file.
+################################################################################
+def print_comparison(results: Dict[str, Any], previous_results: Dict[str, Any]) -> None:
+    print("Compared to {revision}".format(revision=previous_results["revision"]))
+    for name, campaign in results["campaigns"].items():
+        previous_campaign = previous_results["campaigns"].get(name)
+        if previous_campaign is None:
+            continue
+        for timing_name, timing in campaign["timings"].items():
+            previous_timing = previous_campaign["timings"].get(timing_name)
+            if previous_timing is None:
+                continue
+            print("  {name} {timing_name}: {ratio:.2f}x ({previous:.4f}s -> {current:.4f}s)".format(
+                name=name,
+                timing_name=timing_name,
+                ratio=timing["min"] / previous_timing["min"],
+                previous=previous_timing["min"],
+                current=timing["min"],
+            ))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark sunholmexp.py replay against real and synthetic campaigns.")
+    parser.add_argument('--sessions', type=int, nargs="+", default=[1000, 10000], help="The number of sessions in each synthetic campaign.")
+    parser.add_argument('--players', type=int, default=CampaignConfig.players, help="How many players each synthetic campaign starts with.")
+    parser.add_argument('--percent-ratio', type=float, default=CampaignConfig.percent_ratio, help="The chance of a session using a %% based exp grant.")
+    parser.add_argument('--questlog-ratio', type=float, default=CampaignConfig.questlog_ratio, help="The chance of a player writing a quest log.")
+    parser.add_argument('--churn', type=float, default=CampaignConfig.churn, help="The chance of a player being removed, restored or added between sessions.")
+    parser.add_argument('--seed', type=str, default=CampaignConfig.seed, help="The seed for generating campaigns.")
+    parser.add_argument('--repeat', type=int, default=5, help="How many times to time each benchmark.")
+    parser.add_argument('--no-baseline', action='store_true', help="Skip benchmarking the shipped exp_events.json.")
+    parser.add_argument('--output', type=str, default="bench_results.json", help="The file to write the results to.")
+    parser.add_argument('--compare', type=str, help="An earlier results file to compare against.")
+    parsed_args = parser.parse_args()
+
+    campaigns: Dict[str, List[Any]] = {}
+    if not parsed_args.no_baseline:
+        with open(os.path.join(SCRIPT_DIR, sunholmexp.EVENTSOURCE_FILE), "r") as f:
+            campaigns["baseline"] = list(reversed(json.load(f)))
+    for sessions in parsed_args.sessions:
+        config = CampaignConfig(
+            players=parsed_args.players,
+            sessions=sessions,
+            percent_ratio=parsed_args.percent_ratio,
+            questlog_ratio=parsed_args.questlog_ratio,
+            churn=parsed_args.churn,
+            seed=parsed_args.seed,
+        )
+        campaigns["synthetic_{sessions}".format(sessions=sessions)] = generate_campaign(config)
+
+    results: Dict[str, Any] = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "date": datetime.datetime.now().strftime('%Y/%m/%d-%H:%M:%S'),
+        "repeat": parsed_args.repeat,
+        "campaigns": {},
+    }
+    for name, events in campaigns.items():
+        print("Benchmarking {name} ({count} events)".format(name=name, count=len(events)))
+        timings = run_in_temporary_directory(lambda: benchmark_campaign(events, parsed_args.repeat))
+        results["campaigns"][name] = {
+            "events": len(events),
+            "timings": timings,
+        }
+        for timing_name, timing in timings.items():
+            print("  {timing_name}: {min:.4f}s min, {median:.4f}s median".format(timing_name=timing_name, **timing))
+
+    with open(parsed_args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print("Wrote results to {output}".format(output=parsed_args.output))
+
+    if parsed_args.compare:
+        with open(parsed_args.compare, "r") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
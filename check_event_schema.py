@@ -0,0 +1,52 @@
+################################################################################
+# Checks that the event schema accepts exactly the exp amounts that
+# session_total_exp can read, so that an event which passes validation can
+# always be replayed.
+# check_event_schema.py
+################################################################################
+from typing import Any, List
+
+from sunholmexp import State, event_errors, is_exp_amount, session_total_exp
+
+valid_exp_amounts: List[str] = ["25000", "10%", "10%+5000", " 5 % + 100 ", "0", "5%+5%"]
+invalid_exp_amounts: List[Any] = ["5%%", "%", "%5", "5%%+100", "", "+", "5+", "-5", "5.5", "²", "five", 5000, None]
+
+
+def session_event(exp_gained: Any) -> Any:
+    return {
+        "type": "sessionexp",
+        "exp_gained": exp_gained,
+        "players": ["Player"],
+        "questlog_players": [],
+        "fastlog_players": [],
+    }
+
+
+def main() -> None:
+    state = State({"Player": 1000})
+    error_count = 0
+
+    for exp_gained in valid_exp_amounts:
+        event = session_event(exp_gained)
+        if not is_exp_amount(exp_gained) or event_errors(event, state):
+            error_count += 1
+            print("Valid exp amount {exp_gained!r} was rejected".format(exp_gained=exp_gained))
+            continue
+        try:
+            session_total_exp(event, state)
+        except (ValueError, IndexError) as e:
+            error_count += 1
+            print("Valid exp amount {exp_gained!r} could not be read: {error}".format(exp_gained=exp_gained, error=e))
+
+    for exp_gained in invalid_exp_amounts:
+        if is_exp_amount(exp_gained) or not event_errors(session_event(exp_gained), state):
+            error_count += 1
+            print("Invalid exp amount {exp_gained!r} was accepted".format(exp_gained=exp_gained))
+
+    print("errors:", error_count)
+    if error_count > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+################################################################################
+# Checks that the sqlite event database gives the same results as the jsonl
+# event log. The shipped exp_events.json is migrated to the event log in one
+# directory and on to the event database in another, and then the commands
+# that read events are compared between them, before and after more events
+# are imported into both. Also checks that a donor cannot transfer exp twice,
+# and that the database refuses an invalid event without storing anything.
+# check_event_store.py
+################################################################################
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Any, List, Tuple
+
+import sunholmexp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Events imported into both stores after migrating, dated after the shipped
+# events so they are added to the end of the history.
+imported_events: List[Any] = [
+    {"type": "bonusexp", "name": "Avallach", "bonusexp": 1234, "date": "2030/01/01-18:00:00"},
+    {"type": "newplayer", "name": "Check Player", "exp": 300, "date": "2030/01/02-18:00:00"},
+    {"type": "sessionexp", "exp_gained": "10%+5000", "players": ["Check Player"], "questlog_players": ["Avallach"], "fastlog_players": [], "date": "2030/01/03-18:00:00"},
+    {"type": "transfer", "donor": "Avallach", "receiver": "Check Player", "retire_donor": True, "date": "2030/01/04-18:00:00"},
+]
+
+
+def run(directory: str, *args: str) -> Tuple[int, str]:
+    result = subprocess.run(
+        [sys.executable, os.path.join(SCRIPT_DIR, "sunholmexp.py"), "--local", *args],
+        cwd=directory,
+        capture_output=True,
+        text=True,
+    )
+    return result.returncode, result.stdout
+
+
+################################################################################
+# compare_commands
+#
+# Runs each command against both stores and reports any that differ.
+################################################################################
+def compare_commands(jsonl_directory: str, sqlite_directory: str, commands: List[List[str]]) -> int:
+    error_count = 0
+    for command in commands:
+        expected = run(jsonl_directory, *command)
+        actual = run(sqlite_directory, *command)
+        if expected != actual:
+            error_count += 1
+            print("Mismatch running {command}".format(command=" ".join(command)))
+            print("    jsonl ", expected)
+            print("    sqlite", actual)
+    return error_count
+
+
+def player_names(events: List[Any]) -> List[str]:
+    return list(dict.fromkeys(name for event in events for name in sunholmexp.event_player_names(event)))
+
+
+################################################################################
+# check_invalid_insert
+#
+# Inserts a valid event followed by an invalid one straight into the database
+# and checks that the insert is refused and neither event is stored.
+################################################################################
+def check_invalid_insert(sqlite_directory: str) -> int:
+    original_directory = os.getcwd()
+    os.chdir(sqlite_directory)
+    try:
+        event_count = sunholmexp.count_events()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                sunholmexp.insert_database_events([
+                    {"type": "bonusexp", "name": "Check Player", "bonusexp": 1, "date": "2030/02/01-18:00:00"},
+                    {"type": "bonusexp", "name": "Nobody", "bonusexp": 1, "date": "2030/02/02-18:00:00"},
+                ])
+        except ValueError:
+            pass
+        else:
+            print("Invalid event was inserted without an error")
+            return 1
+
+        if sunholmexp.count_events() != event_count:
+            print("Invalid insert was not rolled back")
+            return 1
+        return 0
+    finally:
+        os.chdir(original_directory)
+
+
+def main() -> None:
+    with open(os.path.join(SCRIPT_DIR, sunholmexp.EVENTSOURCE_FILE), "r") as f:
+        events = list(reversed(json.load(f)))
+
+    with tempfile.TemporaryDirectory() as jsonl_directory, tempfile.TemporaryDirectory() as sqlite_directory:
+        for directory in [jsonl_directory, sqlite_directory]:
+            shutil.copy(os.path.join(SCRIPT_DIR, sunholmexp.EVENTSOURCE_FILE), directory)
+            run(directory, "migrate")
+            # Build the timeline index from the event log before the database
+            # exists, so that a stale index would show up below.
+            run(directory, "timeline", "Avallach")
+
+        status, output = run(sqlite_directory, "migrate", "--sqlite")
+        if status != 0 or not os.path.exists(os.path.join(sqlite_directory, sunholmexp.EVENT_DATABASE_FILE)):
+            print("Migrating to the event database failed", output)
+            exit(1)
+
+        commands = [["list"], ["removed"], ["last"], ["history", "1"], ["history", str(len(events) // 2)], ["validate"]]
+        commands += [["timeline", name] for name in player_names(events)]
+        error_count = compare_commands(jsonl_directory, sqlite_directory, commands)
+
+        import_path = os.path.join(sqlite_directory, "imported_events.jsonl")
+        with open(import_path, "w") as f:
+            f.write("".join(json.dumps(event) + "\n" for event in imported_events))
+        for directory in [jsonl_directory, sqlite_directory]:
+            status, output = run(directory, "import", import_path)
+            if status != 0:
+                print("Importing events failed", output)
+                exit(1)
+
+        commands += [["history", str(len(events) + len(imported_events))], ["timeline", "Check Player"]]
+        error_count += compare_commands(jsonl_directory, sqlite_directory, commands)
+
+        # The imported transfer retired its donor, who cannot give exp again
+        for directory in [jsonl_directory, sqlite_directory]:
+            status, output = run(directory, "transfer", "Avallach", "Check Player")
+            if status == 0:
+                error_count += 1
+                print("A donor gave their exp twice", output)
+
+        error_count += check_invalid_insert(sqlite_directory)
+
+    print("errors:", error_count)
+    if error_count > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+################################################################################
+# Checks the transfer_exp scaling over the whole range of xp. Every xp value
+# from 0 to the max is checked to scale monotonically and to convert back to
+# itself, and transfer_xp_scaled_level_range is checked to never give less xp
+# for a bigger donor or receiver over a grid of xp values. Horizontal errors
+# and ties in the grid are drawn to an image the same way tests() draws them.
+# check_transfer_exp.py [--step XP] [--jobs N] [--image FILE]
+################################################################################
+import argparse
+import concurrent.futures
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from PIL import Image
+
+from transfer_exp import level_xp_caps, to_scaled_xp_array, from_scaled_xp_array, transfer_xp_scaled_level_range_array
+
+MAX_XP = level_xp_caps[-1]
+
+
+################################################################################
+# check_scaling_chunk
+#
+# Checks the xp values from start up to stop. The value before start is
+# scaled as well so that the step into the chunk is checked too. Returns the
+# xp values that scale lower than the one before them and the xp values that
+# do not survive a round trip through the scaled xp.
+################################################################################
+def check_scaling_chunk(start: int, stop: int) -> Tuple[List[int], List[int]]:
+    xp = np.arange(max(start - 1, 0), stop, dtype=np.int64)
+    scaled_xp = to_scaled_xp_array(xp)
+
+    decreasing = xp[1:][np.diff(scaled_xp) < 0]
+
+    round_trip = from_scaled_xp_array(scaled_xp)
+    failures = xp[round_trip != xp]
+    failures = failures[failures >= start]
+
+    return decreasing.tolist(), failures.tolist()
+
+
+################################################################################
+# check_transfer_rows
+#
+# Checks rows first to last of the transfer grid, where rows are donor xp and
+# columns are receiver xp. The row after last is computed as well, when there is
+# one, so that the vertical check reaches across into the next chunk. Returns
+# the horizontal and vertical error counts along with the image rows.
+################################################################################
+def check_transfer_rows(grid_xp: npt.NDArray[np.int64], first: int, last: int) -> Tuple[int, int, npt.NDArray[np.uint8]]:
+    rows = transfer_xp_scaled_level_range_array(
+        grid_xp[first:min(last + 1, grid_xp.size), np.newaxis],
+        grid_xp[np.newaxis, :],
+    )
+    chunk = rows[:last - first]
+
+    vertical_errors = int(np.count_nonzero(rows[:-1] > rows[1:]))
+
+    decreasing = chunk[:, :-1] > chunk[:, 1:]
+    equal = chunk[:, :-1] == chunk[:, 1:]
+
+    # Alternate columns are shaded slightly darker, like tests()
+    shade = (255 - (np.arange(1, grid_xp.size) % 2 * 30)).astype(np.uint8)
+    image = np.full((chunk.shape[0], grid_xp.size, 3), 255, dtype=np.uint8)
+    image[:, 1:][decreasing] = 0
+    image[:, 1:, 0][decreasing] = np.broadcast_to(shade, decreasing.shape)[decreasing]
+    image[:, 1:][equal] = 0
+    image[:, 1:, 1][equal] = np.broadcast_to(shade, equal.shape)[equal]
+
+    return int(np.count_nonzero(decreasing)), vertical_errors, image
+
+
+def chunk_bounds(stop: int, chunk_size: int) -> List[Tuple[int, int]]:
+    return [(start, min(start + chunk_size, stop)) for start in range(0, stop, chunk_size)]
+
+
+################################################################################
+# run_chunks
+#
+# Runs a function over every chunk, in a process pool when there is more than
+# one job. Results are yielded in chunk order as they are ready either way.
+################################################################################
+def run_chunks(function: Callable[..., Any], chunks: List[Tuple[Any, ...]], jobs: Optional[int]) -> Iterator[Any]:
+    if jobs == 1:
+        for chunk in chunks:
+            yield function(*chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(function, *zip(*chunks))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check transfer_exp scaling for monotonicity and round trips over the whole xp range.")
+    parser.add_argument('--step', type=int, default=100, help="The xp between rows and columns of the transfer grid.")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="How many xp values to check at a time.")
+    parser.add_argument('--chunk-rows', type=int, default=64, help="How many rows of the transfer grid to check at a time.")
+    parser.add_argument('--jobs', type=int, default=1, help="How many processes to check with. 0 uses one per cpu.")
+    parser.add_argument('--image', type=str, default="errors.png", help="The file to draw the transfer grid errors to.")
+    parsed_args = parser.parse_args()
+
+    jobs = parsed_args.jobs or None
+
+    decreasing: List[int] = []
+    failures: List[int] = []
+    for chunk_decreasing, chunk_failures in run_chunks(check_scaling_chunk, chunk_bounds(MAX_XP + 1, parsed_args.chunk_size), jobs):
+        decreasing += chunk_decreasing
+        failures += chunk_failures
+
+    for xp in decreasing[:20]:
+        print("Invalid Scale", xp)
+    for xp in failures[:20]:
+        print("Failure", xp, int(from_scaled_xp_array(to_scaled_xp_array(xp))))
+    print("scaling errors", len(decreasing))
+    print("round trip errors", len(failures))
+
+    grid_xp = np.arange(0, MAX_XP + 1, parsed_args.step, dtype=np.int64)
+    if grid_xp[-1] != MAX_XP:
+        grid_xp = np.append(grid_xp, MAX_XP)
+
+    row_chunks = [(grid_xp, first, last) for first, last in chunk_bounds(grid_xp.size, parsed_args.chunk_rows)]
+    horizontal_errors = 0
+    vertical_errors = 0
+    # The image takes three bytes per grid cell so is filled in place
+    image = np.full((grid_xp.size, grid_xp.size, 3), 255, dtype=np.uint8)
+    for (_, first, last), (chunk_horizontal_errors, chunk_vertical_errors, chunk_image) in zip(row_chunks, run_chunks(check_transfer_rows, row_chunks, jobs)):
+        horizontal_errors += chunk_horizontal_errors
+        vertical_errors += chunk_vertical_errors
+        image[first:last] = chunk_image
+
+    print("transfer grid {size}x{size}".format(size=grid_xp.size))
+    print("vertical errors", vertical_errors)
+    print("horizontal errors", horizontal_errors)
+
+    Image.fromarray(image, mode="RGB").save(parsed_args.image)
+
+    if decreasing or failures or horizontal_errors or vertical_errors:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
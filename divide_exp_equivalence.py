@@ -0,0 +1,115 @@
+################################################################################
+# Checks that sunholmexp.divide_exp hands out exactly the same exp as the
+# original recursive implementation for randomly generated parties.
+# divide_exp_equivalence.py [--iterations N] [--seed SEED]
+################################################################################
+import argparse
+import math
+import random
+from typing import Any, List
+
+from level_table import MAX_LEVEL, level_exp_caps, get_level_from_exp
+from sunholmexp import LevelingUpPlayer, adjusted_player_award, divide_exp
+
+
+################################################################################
+# recursive_divide_exp
+#
+# The original recursive divide_exp, kept as the reference implementation.
+################################################################################
+def recursive_divide_exp(total_exp: float, players: List[LevelingUpPlayer]) -> Any:
+    if (total_exp == 0):
+        for player in players:
+            player.gained_exp = math.ceil(player.gained_exp)
+
+        return players
+
+    if all(player.leveled_up for player in players):
+        return players
+
+    max_player_level = max([player.level for player in players])
+
+    total_player_slices = sum([adjusted_player_award(max_player_level, player.level) for player in players if not player.leveled_up])
+    for player in players:
+        if player.leveled_up:
+            continue
+        adjusted_award = adjusted_player_award(max_player_level, player.level)
+        player.gained_exp += total_exp * adjusted_award / total_player_slices
+
+    total_leftover_exp: float = 0
+
+    for player in players:
+        if player.level < get_level_from_exp(math.ceil(player.exp + player.gained_exp)):
+            player.leveled_up = True
+            leftover_exp = player.exp + player.gained_exp - level_exp_caps[player.level]
+            player.gained_exp = level_exp_caps[player.level] - player.exp
+            total_leftover_exp += leftover_exp
+
+    return recursive_divide_exp(total_leftover_exp, players)
+
+
+################################################################################
+# random_party
+#
+# Creates a party of players spread across the levels. Some players are placed
+# right at the start or end of their level since that is where rounding
+# differences would show up first.
+################################################################################
+def random_party(rng: random.Random) -> List[LevelingUpPlayer]:
+    players: List[LevelingUpPlayer] = []
+    for i in range(rng.randint(1, 12)):
+        level = rng.randint(1, MAX_LEVEL)
+        level_min, level_max = level_exp_caps[level - 1], max(level_exp_caps[level] - 1, level_exp_caps[level - 1])
+        exp = rng.choice([level_min, level_max, rng.randint(level_min, level_max)])
+        players.append(LevelingUpPlayer(
+            name="Player {i}".format(i=i),
+            exp=exp,
+            level=get_level_from_exp(exp),
+        ))
+    return players
+
+
+def copy_party(players: List[LevelingUpPlayer]) -> List[LevelingUpPlayer]:
+    return [LevelingUpPlayer(name=player.name, exp=player.exp, level=player.level) for player in players]
+
+
+def random_total_exp(rng: random.Random) -> int:
+    return rng.choice([
+        0,
+        rng.randint(1, 100),
+        rng.randint(1, 30000),
+        rng.randint(1, 1000000),
+    ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare divide_exp against the original recursive implementation.")
+    parser.add_argument('--iterations', type=int, default=100000, help="How many random parties to test.")
+    parser.add_argument('--seed', type=str, default="divide_exp", help="The seed for generating parties.")
+    parsed_args = parser.parse_args()
+
+    rng = random.Random(parsed_args.seed)
+
+    error_count = 0
+    for _ in range(parsed_args.iterations):
+        players = random_party(rng)
+        total_exp = random_total_exp(rng)
+
+        expected = recursive_divide_exp(total_exp, copy_party(players))
+        actual = divide_exp(total_exp, copy_party(players))
+
+        expected_awards = [(repr(player.gained_exp), player.leveled_up) for player in expected]
+        actual_awards = [(repr(player.gained_exp), player.leveled_up) for player in actual]
+        if expected_awards != actual_awards:
+            error_count += 1
+            print("Mismatch dividing {total_exp}xp between {players}".format(total_exp=total_exp, players=players))
+            print("    expected", expected_awards)
+            print("    actual  ", actual_awards)
+
+    print("errors:", error_count)
+    if error_count > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import math
+from bisect import bisect_right
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+MAX_LEVEL = 20
+
+################################ Level EXP Caps ################################
+# The The amount of exp you need to be at a specific level.                    #
+################################################################################
+level_exp_caps: List[int] = [
+    0,  # Min XP for level 1
+    300,  # Min XP for Level 2
+    900,  # Min XP for level 3
+    2700,  # Min XP for level 4
+    6500,  # Min XP for level 5
+    14000,  # Min XP for level 6
+    23000,  # Min XP for level 7
+    34000,  # Min XP for level 8
+    48000,  # Min XP for level 9
+    64000,  # Min XP for level 10
+    85000,  # Min XP for level 11
+    100000,  # Min XP for level 12
+    120000,  # Min XP for level 13
+    140000,  # Min XP for level 14
+    165000,  # Min XP for level 15
+    195000,  # Min XP for level 16
+    225000,  # Min XP for level 17
+    265000,  # Min XP for level 18
+    305000,  # Min XP for level 19
+    355000,  # Min XP for level 20
+    355000,  # upper bound threshold at level 20, repeated for index delta convenience
+]
+
+############################### Level EXP Deltas ###############################
+# The amount of exp it takes to get through each level, indexed by level.      #
+# Level 0, which a player is only at with less than no exp, wraps around to    #
+# the last cap the same way the exp for a level has always been worked out.    #
+################################################################################
+level_exp_deltas: List[int] = [
+    level_exp_caps[level] - level_exp_caps[level - 1] for level in range(MAX_LEVEL + 1)
+]
+
+
+################################################################################
+# scaling
+#
+# How many times more exp a level is worth to a character at the source level
+# than to a character at the target level. Every two levels doubles the value.
+################################################################################
+def scaling(source_player_level: int, target_player_level: int) -> float:
+    return math.pow(math.sqrt(2), source_player_level - target_player_level)
+
+
+############################## Scaled EXP Caps #################################
+# The level exp caps with each level's exp scaled to be worth as much as level #
+# 1 exp, so that exp can be compared and moved between characters of any level #
+################################################################################
+scaled_exp_caps: List[int] = [0]
+for i in range(MAX_LEVEL - 1):
+    original_exp_required = level_exp_caps[i + 1] - level_exp_caps[i]
+    scaled_exp_required = math.floor(original_exp_required * scaling(i + 1, 1))
+    scaled_exp_caps.append(scaled_exp_caps[-1] + scaled_exp_required)
+scaled_exp_caps.append(scaled_exp_caps[-1])
+
+
+################################ Level Scalings #################################
+# How many times more exp a level is worth than level 1 exp, indexed by level. #
+################################################################################
+level_scalings: List[float] = [scaling(level, 1) for level in range(MAX_LEVEL + 1)]
+
+
+################################################################################
+# level_from_caps
+#
+# Finds the level for an amount of exp with a binary search over a list of exp
+# caps. Anything at or above the final cap is MAX_LEVEL.
+################################################################################
+def level_from_caps(caps: List[int], exp: float) -> int:
+    return min(bisect_right(caps, exp), MAX_LEVEL)
+
+
+################################################################################
+# get_level_from_exp
+#
+# Calculate what level someone would be given the amount of exp they have.
+################################################################################
+def get_level_from_exp(exp: float) -> int:
+    return level_from_caps(level_exp_caps, exp)
+
+
+def get_level_from_scaled_exp(scaled_exp: float) -> int:
+    return level_from_caps(scaled_exp_caps, scaled_exp)
+
+
+################################################################################
+# levels_from_caps_array
+#
+# The NumPy version of level_from_caps which finds the level of every element
+# of an array of exp values at once.
+################################################################################
+def levels_from_caps_array(caps: List[int], exp: "npt.ArrayLike") -> "npt.NDArray[np.int64]":
+    import numpy as np
+
+    levels: "npt.NDArray[np.int64]" = np.minimum(
+        np.searchsorted(np.asarray(caps), exp, side="right"),
+        MAX_LEVEL,
+    )
+    return levels
+
+
+def get_levels_from_exp_array(exp: "npt.ArrayLike") -> "npt.NDArray[np.int64]":
+    return levels_from_caps_array(level_exp_caps, exp)
+
+
+def get_levels_from_scaled_exp_array(scaled_exp: "npt.ArrayLike") -> "npt.NDArray[np.int64]":
+    return levels_from_caps_array(scaled_exp_caps, scaled_exp)
+
+
+################################################################################
+# to_scaled_exp
+#
+# Converts exp into level 1 exp, scaling the exp in each level by how much that
+# level is worth, so that exp can be moved between characters of any level.
+################################################################################
+def to_scaled_exp(exp: int) -> float:
+    level = get_level_from_exp(exp)
+    gained_exp_in_level = exp - level_exp_caps[level - 1]
+    return level_scalings[level] * gained_exp_in_level + scaled_exp_caps[level - 1]
+
+
+def from_scaled_exp(scaled_exp: float) -> int:
+    level = get_level_from_scaled_exp(scaled_exp)
+    scaled_exp_in_level = scaled_exp - scaled_exp_caps[level - 1]
+    return level_exp_caps[level - 1] + int(round(scaled_exp_in_level / level_scalings[level]))
+
+
+################################################################################
+# transfer_scaled_exp
+#
+# The exp a target ends up with after being given half of a source's exp, with
+# the exp scaled so that it is worth the same to characters of any level. Only
+# looks up the levels in the caps tables, so it takes the same time for any exp.
+################################################################################
+def transfer_scaled_exp(source_exp: int, target_exp: int) -> int:
+    if source_exp <= 0:
+        return target_exp
+
+    scaled_source = int(math.floor(to_scaled_exp(source_exp) * .5))
+    total_scaled_exp = min(scaled_source + to_scaled_exp(target_exp), scaled_exp_caps[-1])
+    return from_scaled_exp(total_scaled_exp)
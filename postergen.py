@@ -5,12 +5,13 @@
 # border never touches the edge of the screen. Then export the image to a png
 # and run this script on the png to generate a properly sized and color
 # balanced png image that can be used for a poster.
-# postergen.py input_image.png output_image.png
+# postergen.py input_image.png output_image.png [--alpha-mode histogram]
 
+import argparse
 import math
-import sys
+import numpy as np
 from PIL import Image  # type: ignore
-from typing import List, Tuple
+from typing import List
 
 total_shares: float = 0
 for i in range(0, 237):
@@ -31,57 +32,92 @@ share_threshold: List[float] = [0]
 for i in range(0, 254):
     share_threshold.append(share_threshold[-1] + shares[i])
 
-im = Image.open(sys.argv[1])
-
-
-def get_luma(red: int, green: int, blue: int) -> float:
-    return (red * 0.3 + green * 0.59 + blue * 0.11)
-
-
-pixel_values: List[Tuple[float, int, int]] = []
-
-white_pixels: List[Tuple[int, int]] = []
+################################################################################
+# Alpha Modes
+#
+# exact ranks every pixel by sorting their luma. histogram instead counts the
+# pixels in each of HISTOGRAM_BINS luma ranges and gives every pixel in a range
+# the alpha of the range's middle rank. A pixel's exact alpha is somewhere in
+# the alpha steps its bin's ranks span, so this is off by at most that span.
+# Bins that span more than HISTOGRAM_MAX_ALPHA_STEPS steps, such as a large
+# area of a single color, are sorted so their pixels get their exact alpha.
+# Every pixel's alpha is within HISTOGRAM_MAX_ALPHA_STEPS of exact mode, and
+# only the pixels in those wide bins are sorted.
+#
+# That holds before the poster is resized to OUTPUT_SIZE. The resize filters
+# the image in two passes, rounding after each. Each pass weighs the pixels
+# with a bicubic filter whose weights add up to at most about 1.08 when
+# counted without their signs, so a difference of 1 can become 2 after the
+# first pass and 3 after the second. The saved poster's alpha is within
+# HISTOGRAM_MAX_SAVED_ALPHA_STEPS of exact mode.
+################################################################################
+ALPHA_MODES = ["exact", "histogram"]
+HISTOGRAM_BINS = 4096
+HISTOGRAM_MAX_ALPHA_STEPS = 1
+HISTOGRAM_MAX_SAVED_ALPHA_STEPS = 3
+OUTPUT_SIZE = (256, 256)
+
+parser = argparse.ArgumentParser(description="Generate a balanced poster image from a source image.")
+parser.add_argument('input', type=str, help="The image to generate the poster from.")
+parser.add_argument('output', type=str, help="The file to save the poster to.")
+parser.add_argument('--alpha-mode', type=str, choices=ALPHA_MODES, default="exact", help="Rank pixels by sorting them, or by counting them in a histogram of luma which is faster but can leave the saved poster's alpha off by {steps}.".format(steps=HISTOGRAM_MAX_SAVED_ALPHA_STEPS))
+parsed_args = parser.parse_args()
+
+im = Image.open(parsed_args.input)
 
 im.putalpha(255)
 
-pixels = im.load()
-width, height = im.size
-
-for x in range(width):
-    for y in range(height):
-        color = pixels[x, y]
-        luma = get_luma(color[0], color[1], color[2])
-        if luma < 255.0:
-            pixel_values.append((luma, x, y))
-        else:
-            white_pixels.append((x, y))
-
-pixel_values.sort(key=lambda x: x[0])
-
-pixel_share_threshold = []
-for i in range(254):
-    pixel_share_threshold.append(math.floor(share_threshold[i] * len(pixel_values)))
-
-pixel_share_threshold.append(len(pixel_values))
-
-alpha_index = 0
-
-for i, pixel in enumerate(pixel_values):
-    luma = pixel[0]
-    x = pixel[1]
-    y = pixel[2]
-
-    if i > pixel_share_threshold[alpha_index]:
-        alpha_index += 1
-
-    alpha = 255 - alpha_index
-
-    pixels[x, y] = (0, 0, 0, alpha)
-
-for white_pixel in white_pixels:
-    x = white_pixel[0]
-    y = white_pixel[1]
-    pixels[x, y] = (0, 0, 0, 0)
+# Pixels are ranked in column order, so that pixels with the same luma keep
+# the order they had when the image was walked one column at a time.
+pixels = np.asarray(im).transpose(1, 0, 2).reshape(-1, 4)
+
+red = pixels[:, 0].astype(np.float64)
+green = pixels[:, 1].astype(np.float64)
+blue = pixels[:, 2].astype(np.float64)
+luma = red * 0.3 + green * 0.59 + blue * 0.11
+
+colored_pixels = np.flatnonzero(luma < 255.0)
+pixel_count = len(colored_pixels)
+
+pixel_share_threshold = np.floor(np.array(share_threshold[:254]) * pixel_count).astype(np.int64)
+
+# The alpha index steps down by one at the first pixel past its share
+# threshold, but never more than once per pixel, so step k happens at pixel
+# k + 1 + the running max of pixel_share_threshold[j] - j. The alpha index at
+# a rank is the number of steps at or before it.
+alpha_steps = np.arange(1, 255) + np.maximum.accumulate(pixel_share_threshold - np.arange(254))
+
+# White pixels are left fully transparent
+alpha = np.zeros(len(pixels), dtype=np.uint8)
+
+if parsed_args.alpha_mode == "exact":
+    pixel_values = colored_pixels[np.argsort(luma[colored_pixels], kind="stable")]
+    alpha[pixel_values] = 255 - np.searchsorted(alpha_steps, np.arange(pixel_count), side="right")
+else:
+    luma_bins = np.minimum(luma[colored_pixels] * (HISTOGRAM_BINS / 255.0), HISTOGRAM_BINS - 1).astype(np.int64)
+    bin_counts = np.bincount(luma_bins, minlength=HISTOGRAM_BINS)
+    bin_first_ranks = np.cumsum(bin_counts) - bin_counts
+    bin_middle_ranks = bin_first_ranks + (bin_counts - 1) // 2
+    bin_alpha = 255 - np.searchsorted(alpha_steps, bin_middle_ranks, side="right")
+    alpha[colored_pixels] = bin_alpha[luma_bins]
+
+    bin_alpha_steps = (
+        np.searchsorted(alpha_steps, bin_first_ranks + bin_counts - 1, side="right")
+        - np.searchsorted(alpha_steps, bin_first_ranks, side="right")
+    )
+    wide_pixels = np.flatnonzero((bin_alpha_steps > HISTOGRAM_MAX_ALPHA_STEPS)[luma_bins])
+
+    # Sorting by bin and then luma, with ties left in column order, puts each
+    # wide bin's pixels in the order exact mode ranks them
+    wide_pixels = wide_pixels[np.lexsort((luma[colored_pixels[wide_pixels]], luma_bins[wide_pixels]))]
+    wide_bins = luma_bins[wide_pixels]
+    rank_in_bin = np.arange(len(wide_pixels)) - np.searchsorted(wide_bins, wide_bins, side="left")
+    wide_ranks = bin_first_ranks[wide_bins] + rank_in_bin
+    alpha[colored_pixels[wide_pixels]] = 255 - np.searchsorted(alpha_steps, wide_ranks, side="right")
+
+poster = np.zeros((im.size[1], im.size[0], 4), dtype=np.uint8)
+poster[:, :, 3] = alpha.reshape(im.size[0], im.size[1]).T
+im.frombytes(poster.tobytes())
 
 # Save the modified image
-im.resize((256, 256)).save(sys.argv[2])
+im.resize(OUTPUT_SIZE).save(parsed_args.output)
@@ -5,35 +5,27 @@ import random
 import datetime
 import argparse
 import os
-from typing import Any, List, Dict
+import hashlib
+import struct
+import itertools
+import csv
+import collections
+import asyncio
+import concurrent.futures
+import socket
+import sqlite3
+import signal
+import io
+import contextlib
+import functools
+import traceback
+import time
+import cProfile
+import pstats
+import urllib.parse
+from typing import AbstractSet, Any, BinaryIO, Callable, List, Dict, Iterable, Iterator, Mapping, Optional, Set, Tuple
 from dataclasses import dataclass
-
-################################ Level EXP Caps ################################
-# The The amount of exp you need to be at a specific level.                    #
-################################################################################
-level_exp_caps: List[int] = [
-    0,  # Min XP for level 1
-    300,  # Min XP for Level 2
-    900,  # Min XP for level 3
-    2700,  # Min XP for level 4
-    6500,  # Min XP for level 5
-    14000,  # Min XP for level 6
-    23000,  # Min XP for level 7
-    34000,  # Min XP for level 8
-    48000,  # Min XP for level 9
-    64000,  # Min XP for level 10
-    85000,  # Min XP for level 11
-    100000,  # Min XP for level 12
-    120000,  # Min XP for level 13
-    140000,  # Min XP for level 14
-    165000,  # Min XP for level 15
-    195000,  # Min XP for level 16
-    225000,  # Min XP for level 17
-    265000,  # Min XP for level 18
-    305000,  # Min XP for level 19
-    355000,  # Min XP for level 20
-    355000,  # upper bound threshold at level 20, repeated for index delta convenience
-]
+from level_table import MAX_LEVEL, level_exp_caps, level_exp_deltas, get_level_from_exp, transfer_scaled_exp
 
 ############################## Quest Log Gold Map ##############################
 # A lookup table for mapping the level of a character to the rng units to use  #
@@ -122,8 +114,6 @@ quest_log_gold_map = [
     },
 ]
 
-MAX_LEVEL = 20
-
 # Ideally, the most levels anyone will be behind the highest level in the faction
 # If you are outside this window you will be automatically granted 1 level after each session
 DESIRED_LEVEL_WINDOW = 5
@@ -132,13 +122,606 @@ DESIRED_LEVEL_WINDOW = 5
 
 EVENTSOURCE_FILE="exp_events.json"
 
+# New events are appended to this newline delimited log, one event per line in
+# chronological order. Once it exists it replaces EVENTSOURCE_FILE as the source
+# of events, and EVENTSOURCE_FILE is only rewritten by the export command.
+EVENTLOG_FILE = "exp_events.jsonl"
+
+# The byte offset of every event in the event log, and the digest of the
+# events up to it, are kept in this index so that any event, and the snapshot
+# to replay it from, can be found without reading the log from the start.
+EVENT_INDEX_FILE = "exp_events.index"
+
+# Each player's timeline, every event that changed them, is kept in its own
+# file in this directory.
+TIMELINE_DIR = "exp_events.timeline"
+
+# An optional sqlite database of events, created with the migrate command's
+# --sqlite flag. Once it exists it is used instead of both EVENTSOURCE_FILE and
+# EVENTLOG_FILE.
+EVENT_DATABASE_FILE = "exp_events.sqlite3"
+
+# The daemon started by the serve command listens on this unix socket, and
+# other commands are sent to it while it is running.
+DAEMON_SOCKET_FILE = "exp_events.sock"
+
+# Replayed states are cached in this directory so that commands only need to
+# replay the events that were added since the newest valid snapshot.
+SNAPSHOT_DIR = "exp_events.snapshots"
+
+# A snapshot is kept after every SNAPSHOT_INTERVAL events, along with the most
+# recent SNAPSHOT_TAIL_LIMIT snapshots that were taken between the intervals.
+SNAPSHOT_INTERVAL = 100
+SNAPSHOT_TAIL_LIMIT = 4
+
+# At most SNAPSHOT_CACHE_LIMIT of the interval snapshots are kept for each
+# campaign. When there are more, the ones that were least recently saved or
+# loaded are removed first.
+SNAPSHOT_CACHE_LIMIT = 50
+
+# How much of the event log before a snapshot's offset is hashed to check that
+# the log it was taken from has not been rewritten.
+EVENT_LOG_TAIL_BYTES = 4096
+
+# The campaigns that can be chosen with --campaign, as a json object mapping
+# each campaign's name to the directory its events are kept in.
+CAMPAIGN_REGISTRY_FILE = "campaigns.json"
+
+# Setting this environment variable profiles every command, the same as passing
+# --profile. Its value can be any of PROFILE_MODES.
+PROFILE_ENVIRONMENT_VARIABLE = "SUNHOLMEXP_PROFILE"
+PROFILE_MODES = ["summary", "cprofile", "trace"]
+PROFILE_STATS_FILE = "sunholmexp.pstats"
+PROFILE_TRACE_FILE = "sunholmexp.trace.json"
+
+############################### Import CSV Fields ##############################
+# The columns read from each row of a csv import file for each type of event,  #
+# and how to convert the text of each cell. Lists of players are separated     #
+# with semicolons. Empty cells are left out of the event.                      #
+################################################################################
+def split_players(cell: str) -> List[str]:
+    return [player.strip() for player in cell.split(";") if player.strip()]
+
+
+def parse_bool(cell: str) -> bool:
+    return cell.strip().lower() in ["1", "true", "yes", "y"]
+
+
+import_csv_fields: Dict[str, Dict[str, Callable[[str], Any]]] = {
+    "sessionexp": {
+        "exp_gained": str,
+        "players": split_players,
+        "questlog_players": split_players,
+        "fastlog_players": split_players,
+    },
+    "newplayer": {
+        "name": str,
+        "exp": int,
+    },
+    "bonusexp": {
+        "name": str,
+        "bonusexp": int,
+    },
+    "levelup": {
+        "name": str,
+        "levels": int,
+        "preserve_percentage": parse_bool,
+    },
+    "removeplayer": {
+        "name": str,
+    },
+    "restoreplayer": {
+        "name": str,
+    },
+    "transfer": {
+        "donor": str,
+        "receiver": str,
+        "retire_donor": parse_bool,
+    },
+}
+
+################################## Event Schema ################################
+# The fields each type of event must have and what kind of value each field    #
+# holds. Every event also has a "type" and, once it has been added, a "date".  #
+################################################################################
+# Each chunk of an exp amount is a whole number with at most one "%" after it,
+# the same as session_total_exp reads it.
+def is_exp_gain_chunk(exp_gain_chunk: str) -> bool:
+    amount = exp_gain_chunk.strip()
+    if amount.endswith("%"):
+        amount = amount[:-1]
+    return amount.strip().isdecimal()
+
+
+def is_exp_amount(value: Any) -> bool:
+    return isinstance(value, str) and all(is_exp_gain_chunk(exp_gain_chunk) for exp_gain_chunk in value.split("+"))
+
+
+event_field_checks: Dict[str, Callable[[Any], bool]] = {
+    "text": lambda value: isinstance(value, str) and value.strip() != "",
+    "a whole number": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "true or false": lambda value: isinstance(value, bool),
+    "a list of players": lambda value: isinstance(value, list) and all(isinstance(player, str) for player in value),
+    "an exp amount like 25000 or 10%+5000": is_exp_amount,
+}
+
+event_schema: Dict[str, Dict[str, str]] = {
+    "sessionexp": {
+        "exp_gained": "an exp amount like 25000 or 10%+5000",
+        "players": "a list of players",
+        "questlog_players": "a list of players",
+        "fastlog_players": "a list of players",
+    },
+    "newplayer": {
+        "name": "text",
+        "exp": "a whole number",
+    },
+    "bonusexp": {
+        "name": "text",
+        "bonusexp": "a whole number",
+    },
+    "levelup": {
+        "name": "text",
+        "levels": "a whole number",
+        "preserve_percentage": "true or false",
+    },
+    "removeplayer": {
+        "name": "text",
+    },
+    "restoreplayer": {
+        "name": "text",
+    },
+    "transfer": {
+        "donor": "text",
+        "receiver": "text",
+        "retire_donor": "true or false",
+    },
+}
+
+
+################################################################################
+# compile_event_validator
+#
+# Turns the schema for one type of event into a function that lists what is
+# wrong with the shape of an event of that type. The field checks are looked
+# up once here rather than for every event.
+################################################################################
+def compile_event_validator(fields: Dict[str, str]) -> Callable[[Any], List[str]]:
+    checks = [(field, kind, event_field_checks[kind]) for field, kind in fields.items()]
+    known_fields = set(fields) | {"type", "date"}
+
+    def validate(event: Any) -> List[str]:
+        missing_fields = [field for field, _, _ in checks if field not in event]
+        if missing_fields:
+            return ["Missing {fields}".format(fields=", ".join(missing_fields))]
+
+        errors = [
+            "{field} must be {kind}".format(field=field, kind=kind)
+            for field, kind, check in checks
+            if not check(event[field])
+        ]
+        if "date" in event and not isinstance(event["date"], str):
+            errors.append("date must be text")
+        unknown_fields = [field for field in event if field not in known_fields]
+        if unknown_fields:
+            errors.append("Unknown {fields}".format(fields=", ".join(unknown_fields)))
+        return errors
+
+    return validate
+
+
+event_validators: Dict[str, Callable[[Any], List[str]]] = {
+    event_type: compile_event_validator(fields) for event_type, fields in event_schema.items()
+}
+
+################################################################################
+# State
+#
+# The exp of every player, and of every removed player, after some number of
+# events, along with the players who have given their exp away. Clones share their dictionaries with the state they were cloned from
+# until one of them is changed, so holding many states (one per campaign, or
+# one per point in history) only costs memory for the states that diverge.
+# Changes must go through the methods below so shared dictionaries are copied
+# before they are written to.
+################################################################################
 class State:
-    players: Dict[str,int] = {}
-    removed_players: Dict[str, int] = {}
+    __slots__ = ("_players", "_removed_players", "_donors", "_shared")
+
+    def __init__(
+        self,
+        players: Optional[Dict[str, int]] = None,
+        removed_players: Optional[Dict[str, int]] = None,
+        donors: Optional[Set[str]] = None,
+    ) -> None:
+        self._players: Dict[str, int] = {} if players is None else players
+        self._removed_players: Dict[str, int] = {} if removed_players is None else removed_players
+        self._donors: Set[str] = set() if donors is None else donors
+        self._shared = False
+
+    @property
+    def players(self) -> Mapping[str, int]:
+        return self._players
+
+    @property
+    def removed_players(self) -> Mapping[str, int]:
+        return self._removed_players
+
+    @property
+    def donors(self) -> AbstractSet[str]:
+        return self._donors
+
+    def clone(self) -> "State":
+        clone = State(self._players, self._removed_players, self._donors)
+        clone._shared = True
+        self._shared = True
+        return clone
+
+    def _unshare(self) -> None:
+        if self._shared:
+            self._players = dict(self._players)
+            self._removed_players = dict(self._removed_players)
+            self._donors = set(self._donors)
+            self._shared = False
+
+    def set_player_exp(self, name: str, exp: int) -> None:
+        self._unshare()
+        self._players[name] = exp
+
+    def remove_player(self, name: str) -> None:
+        self._unshare()
+        self._removed_players[name] = self._players.pop(name)
+
+    def restore_player(self, name: str) -> None:
+        self._unshare()
+        self._players[name] = self._removed_players.pop(name)
+
+    def add_donor(self, name: str) -> None:
+        self._unshare()
+        self._donors.add(name)
+
+################################################################################
+# Profiler
+#
+# Records how long each phase of a command takes and how many times it runs.
+# Profiling is turned on with --profile or the SUNHOLMEXP_PROFILE environment
+# variable. The summary is printed to stderr so that it never mixes with the
+# output of the command. The trace mode also writes every phase as a Chrome
+# trace that can be opened in chrome://tracing or Perfetto.
+################################################################################
+class Profiler:
+    def __init__(self, mode: str) -> None:
+        self.mode = mode
+        self.start = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.maximums: Dict[str, int] = {}
+        self.trace_events: List[Any] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str, trace: bool = True) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = self.timings.get(name, 0) + end - start
+            self.count(name)
+            if trace and self.mode == "trace":
+                self.trace_events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.start) * 1000000,
+                    "dur": (end - start) * 1000000,
+                    "pid": os.getpid(),
+                    "tid": 0,
+                })
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def maximum(self, name: str, value: int) -> None:
+        self.maximums[name] = max(self.maximums.get(name, value), value)
+
+    def report(self) -> str:
+        lines = ["Profile ({total:.4f}s total)".format(total=time.perf_counter() - self.start)]
+        for name in sorted(self.timings, key=self.timings.__getitem__, reverse=True):
+            lines.append("  {name}: {seconds:.4f}s over {count} calls".format(
+                name=name,
+                seconds=self.timings[name],
+                count=self.counts[name],
+            ))
+        for name in sorted(set(self.counts) - set(self.timings)):
+            lines.append("  {name}: {count}".format(name=name, count=self.counts[name]))
+        for name in sorted(self.maximums):
+            lines.append("  {name}: {value}".format(name=name, value=self.maximums[name]))
+        return "\n".join(lines)
+
+    def write_trace(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events}, f)
+
+
+# The running profiler, or None when profiling is off. Hot paths check this
+# directly so that they cost nothing extra when profiling is off.
+profiler: Optional[Profiler] = None
+
+
+def profile_phase(name: str) -> "contextlib.AbstractContextManager[None]":
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+################################################################################
+# count_calls
+#
+# Wraps a function so the profiler counts every call to it. The wrapper is only
+# swapped in while profiling so that the function is not slowed down otherwise.
+################################################################################
+def count_calls(name: str, function: Callable[..., Any]) -> Callable[..., Any]:
+    def counted_function(*args: Any, **kwargs: Any) -> Any:
+        if profiler is not None:
+            profiler.count(name)
+        return function(*args, **kwargs)
+    return counted_function
+
+
+################################################################################
+# run_profiled_command
+#
+# Runs a command with profiling on and reports the results. The cprofile mode
+# profiles every function call with cProfile as well, saving the stats to
+# PROFILE_STATS_FILE and printing the most expensive calls.
+################################################################################
+def run_profiled_command(parsed_args: argparse.Namespace, mode: str) -> None:
+    global profiler, get_level_from_exp
+    profiler = Profiler(mode)
+    original_get_level_from_exp = get_level_from_exp
+    get_level_from_exp = count_calls("get_level_from_exp", get_level_from_exp)
+
+    call_profile = cProfile.Profile() if mode == "cprofile" else None
+    try:
+        if call_profile is not None:
+            call_profile.enable()
+        with profiler.phase("command"):
+            run_command(parsed_args)
+    finally:
+        if call_profile is not None:
+            call_profile.disable()
+        get_level_from_exp = original_get_level_from_exp
+
+        sys.stdout.flush()
+        print(profiler.report(), file=sys.stderr)
+
+        if call_profile is not None:
+            call_profile.dump_stats(PROFILE_STATS_FILE)
+            stats = pstats.Stats(call_profile, stream=sys.stderr)
+            stats.sort_stats("cumulative").print_stats(25)
+            print("Wrote cProfile stats to {path}".format(path=PROFILE_STATS_FILE), file=sys.stderr)
+
+        if mode == "trace":
+            profiler.write_trace(PROFILE_TRACE_FILE)
+            print("Wrote Chrome trace to {path}".format(path=PROFILE_TRACE_FILE), file=sys.stderr)
+
+        profiler = None
+
+
+################################################################################
+# profile_mode
+#
+# The profiling mode from the --profile flags, or from the SUNHOLMEXP_PROFILE
+# environment variable where any value other than a mode name means the
+# summary.
+################################################################################
+def profile_mode(parsed_args: argparse.Namespace) -> Optional[str]:
+    if parsed_args.profile_mode is not None:
+        mode: str = parsed_args.profile_mode
+        return mode
+    if parsed_args.profile:
+        return "summary"
+
+    environment_mode = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "")
+    if environment_mode in ["", "0"]:
+        return None
+    if environment_mode in PROFILE_MODES:
+        return environment_mode
+    return "summary"
+
+
+################################################################################
+# Campaign
+#
+# Where one campaign keeps its events and caches. Every file is kept in the
+# campaign's directory, and the default campaign uses the working directory.
+################################################################################
+@dataclass(frozen=True)
+class Campaign:
+    name: str
+    directory: str = ""
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    @property
+    def event_source_file(self) -> str:
+        return self.path(EVENTSOURCE_FILE)
+
+    @property
+    def event_log_file(self) -> str:
+        return self.path(EVENTLOG_FILE)
+
+    @property
+    def event_index_file(self) -> str:
+        return self.path(EVENT_INDEX_FILE)
+
+    @property
+    def event_database_file(self) -> str:
+        return self.path(EVENT_DATABASE_FILE)
+
+    @property
+    def timeline_dir(self) -> str:
+        return self.path(TIMELINE_DIR)
+
+    @property
+    def daemon_socket_file(self) -> str:
+        return self.path(DAEMON_SOCKET_FILE)
+
+    @property
+    def snapshot_dir(self) -> str:
+        return self.path(SNAPSHOT_DIR)
+
+
+# The campaign every command works on.
+campaign = Campaign("default")
+
+
+@contextlib.contextmanager
+def use_campaign(selected: Campaign) -> Iterator[Campaign]:
+    global campaign
+    previous_campaign = campaign
+    campaign = selected
+    try:
+        yield selected
+    finally:
+        campaign = previous_campaign
+
+
+################################################################################
+# read_campaign_registry
+#
+# Reads every registered campaign. Directories are stored relative to the
+# directory of the registry file, so that they can be moved together, and are
+# read back as absolute paths so they do not depend on the working directory.
+################################################################################
+def read_campaign_registry() -> Dict[str, Campaign]:
+    if not os.path.exists(CAMPAIGN_REGISTRY_FILE):
+        return {}
+
+    with open(CAMPAIGN_REGISTRY_FILE, "r") as f:
+        registry: Dict[str, str] = json.load(f)
+
+    return {
+        name: Campaign(name, os.path.normpath(os.path.join(campaign_registry_directory(), directory)))
+        for name, directory in registry.items()
+    }
+
+
+def write_campaign_registry(campaigns: Dict[str, Campaign]) -> None:
+    write_file_atomically(CAMPAIGN_REGISTRY_FILE, json.dumps(
+        {name: os.path.relpath(os.path.abspath(selected.directory), campaign_registry_directory()) for name, selected in sorted(campaigns.items())},
+        indent=4,
+    ))
+
+
+def campaign_registry_directory() -> str:
+    return os.path.dirname(os.path.abspath(CAMPAIGN_REGISTRY_FILE))
+
+
+################################################################################
+# replay_campaign
+#
+# Replays a campaign and returns how many events it has along with the state
+# after them. This is the unit of work replay_campaigns runs in each worker.
+################################################################################
+def replay_campaign(selected: Campaign) -> Tuple[int, State]:
+    with use_campaign(selected), contextlib.redirect_stdout(io.StringIO()):
+        state, _ = replay_to()
+        return count_events(), state
+
+
+################################################################################
+# replay_campaigns
+#
+# Replays many campaigns at once in a process pool, returning the event count
+# and state of each campaign by name. Every campaign has its own files and
+# snapshot cache so the replays do not share anything.
+################################################################################
+def replay_campaigns(campaigns: List[Campaign], jobs: Optional[int] = None) -> Dict[str, Tuple[int, State]]:
+    if jobs == 1 or len(campaigns) <= 1:
+        return {selected.name: replay_campaign(selected) for selected in campaigns}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(
+            [selected.name for selected in campaigns],
+            executor.map(replay_campaign, campaigns),
+        ))
+
+
+################################################################################
+# list_campaigns
+#
+# Prints every registered campaign with how many events it has.
+################################################################################
+def list_campaigns() -> None:
+    campaigns = read_campaign_registry()
+    if not campaigns:
+        print("No campaigns are registered in {registry}".format(registry=CAMPAIGN_REGISTRY_FILE))
+        return
+
+    for name, selected in sorted(campaigns.items()):
+        with use_campaign(selected):
+            print("{name} ({directory}) {count} events".format(
+                name=name,
+                directory=selected.directory,
+                count=count_events(),
+            ))
+
+
+################################################################################
+# refresh_campaigns
+#
+# Replays every registered campaign, bringing their snapshots up to date, and
+# prints each campaign's roster.
+################################################################################
+def refresh_campaigns(jobs: Optional[int] = None) -> None:
+    campaigns = read_campaign_registry()
+    if not campaigns:
+        print("No campaigns are registered in {registry}".format(registry=CAMPAIGN_REGISTRY_FILE))
+        exit(1)
+
+    results = replay_campaigns(list(campaigns.values()), jobs)
+
+    for name, (event_count, state) in sorted(results.items()):
+        output_string = "{name}: {count} events".format(name=name, count=event_count)
+        print(output_string)
+        print("="*len(output_string))
+        list_current_state(state=state)
+        print("")
+
 
 def main() -> None:
-    parser = argparse.ArgumentParser(description="A Tool For Managing and Leveling Sunholm Players")
+    global campaign
+    parsed_args = build_parser().parse_args()
+
+    if parsed_args.campaign is not None:
+        campaigns = read_campaign_registry()
+        if parsed_args.campaign not in campaigns:
+            print("There is no campaign named {name} in {registry}".format(name=parsed_args.campaign, registry=CAMPAIGN_REGISTRY_FILE))
+            exit(1)
+        campaign = campaigns[parsed_args.campaign]
+
+    mode = profile_mode(parsed_args)
+
+    # Let a running daemon answer the command from its already replayed state.
+    # Profiling has to happen in this process to see where the time goes.
+    if parsed_args.command != "serve" and not parsed_args.local and mode is None:
+        status = send_to_daemon(absolute_path_arguments(parsed_args))
+        if status is not None:
+            exit(status)
+
+    if mode is not None:
+        run_profiled_command(parsed_args, mode)
+        return
 
+    run_command(parsed_args)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="A Tool For Managing and Leveling Sunholm Players")
+    parser.add_argument('--local', help="Run the command in this process even if a daemon is running.", action='store_true')
+    parser.add_argument('--campaign', type=str, help="The name of the registered campaign to use instead of the one in the working directory.")
+    parser.add_argument('--profile', help="Report how long each phase of the command took. Runs the command in this process.", action='store_true')
+    parser.add_argument('--profile-mode', type=str, choices=PROFILE_MODES, help="Also profile every call with cProfile, or write a Chrome trace. Implies --profile.")
 
     subparsers = parser.add_subparsers(help="Commands", dest="command")
 
@@ -162,12 +745,32 @@ def main() -> None:
     parser_levelup.add_argument('levels', type=int, help="How many bonus levels to give.")
     parser_levelup.add_argument('--preserve-percentage', help="Preserve level progress as a percentage.", action='store_true')
 
+    parser_transfer = subparsers.add_parser("transfer", help="Give half of a player's exp to another player, scaled to be worth the same at the receiver's level")
+    parser_transfer.add_argument('donor', type=str, help="The name of the player giving exp. They can be a removed player.")
+    parser_transfer.add_argument('receiver', type=str, help="The name of the player receiving exp.")
+    parser_transfer.add_argument('--retire-donor', help="Remove the donor once their exp has been given.", action='store_true')
+
     parser_player_list = subparsers.add_parser("list", help="List current exp and levels")
     parser_player_list.add_argument('playername', type=str, nargs="?", default="", help="The name of the player.")
     parser_player_list.add_argument('--sortby', type=str, choices=["exp", "name"], help="Sort list output")
 
-    parser_last_event = subparsers.add_parser("last", help="Print out the change dialog from the most recent session")
-    # TODO, maybe an ability to print out an even more early one
+    subparsers.add_parser("last", help="Print out the change dialog from the most recent session")
+
+    parser_history = subparsers.add_parser("history", help="Print out the change dialog from earlier events")
+    parser_history.add_argument('events', type=int, nargs="*", help="The numbers of the events to show, counting from 1. Zero and negative numbers count back from the most recent event.")
+    parser_history.add_argument('--since', type=str, help="Show every event on or after this date, eg 2023/09/20")
+    parser_history.add_argument('--until', type=str, help="Show every event on or before this date, eg 2023/09/20")
+
+    parser_timeline = subparsers.add_parser("timeline", help="Print out every event that changed a player")
+    parser_timeline.add_argument('playername', type=str, help="The name of the player.")
+
+    parser_simulate = subparsers.add_parser("simulate", help="Preview the result of sessions without adding any events.")
+    parser_simulate.add_argument('exp', type=str, nargs="+", help="The amounts of exp to compare, in the same format as the exp command.")
+    parser_simulate.add_argument('-p', '--player', metavar="player", type=str, action='append', default=[], help="A player who would participate this session.")
+    parser_simulate.add_argument('-q', '--questlog', metavar="player", type=str, action='append', default=[], help="A player who would have written a quest log.")
+    parser_simulate.add_argument('-f', '--fastlog', metavar="player", type=str, action='append', default=[], help="A player who would have written a quest log within the time limit.")
+    parser_simulate.add_argument('--party', type=str, action='append', default=[], help="Another set of players to compare, separated by commas. Prefix a player with q: or f: for quest logs.")
+    parser_simulate.add_argument('--jobs', type=int, help="How many processes to simulate with. Defaults to one per cpu.")
 
     parser_remove_player = subparsers.add_parser("remove", help="Remove a player from the list so they are no longer displayed.")
     parser_remove_player.add_argument('playername', type=str, help="The name of the player to remove.")
@@ -179,10 +782,31 @@ def main() -> None:
     parser_removed_players.add_argument('playername', type=str, nargs="?", default="", help="The name of the player.")
     parser_removed_players.add_argument('--sortby', type=str, choices=["exp", "name"], help="Sort list output")
 
+    parser_migrate = subparsers.add_parser("migrate", help="Convert the json event source into the append only event log.")
+    parser_migrate.add_argument('--sqlite', help="Move the events into a sqlite database instead.", action='store_true')
+
+    parser_import = subparsers.add_parser("import", help="Add many events from a csv or jsonl file at once.")
+    parser_import.add_argument('file', type=str, help="The csv or jsonl file of events to import.")
+    parser_import.add_argument('--format', type=str, choices=["csv", "jsonl"], help="The format of the file, guessed from the file extension if not given.")
+
+    parser_export = subparsers.add_parser("export", help="Compact the event log and export it as newest-first json.")
+    parser_export.add_argument('--output', type=str, help="The file to write the exported events to. Defaults to the campaign's {source}.".format(source=EVENTSOURCE_FILE))
+
+    parser_campaigns = subparsers.add_parser("campaigns", help="List, add or remove the campaigns that can be chosen with --campaign.")
+    parser_campaigns.add_argument('--add', nargs=2, metavar=("name", "directory"), help="Register a campaign kept in a directory.")
+    parser_campaigns.add_argument('--remove', metavar="name", type=str, help="Unregister a campaign. Its files are left alone.")
 
-    parsed_args = parser.parse_args()
+    parser_refresh = subparsers.add_parser("refresh", help="Replay every registered campaign at once and print their rosters.")
+    parser_refresh.add_argument('--jobs', type=int, help="How many campaigns to replay at once. Defaults to one per cpu.")
 
+    subparsers.add_parser("validate", help="Check every event against the event schema and the state before it.")
 
+    subparsers.add_parser("serve", help="Run a daemon that keeps the replayed state in memory and answers commands sent to it.")
+
+    return parser
+
+
+def run_command(parsed_args: argparse.Namespace, cache: Optional["EventCache"] = None) -> None:
     # print(parsed_args)
     if parsed_args.command == "exp":
         add_exp_event(
@@ -191,14 +815,14 @@ def main() -> None:
             questlog_players=parsed_args.questlog,
             fastlog_players=parsed_args.fastlog,
         )
-        list_previous_update()
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "new":
         add_new_player_event(
             player_name=parsed_args.playername,
             starting_exp=parsed_args.startingxp)
-        list_previous_update()
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "bonus":
@@ -206,7 +830,7 @@ def main() -> None:
             player_name=parsed_args.playername,
             bonus_exp=parsed_args.bonusxp
         )
-        list_previous_update()
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "levelup":
@@ -215,64 +839,1097 @@ def main() -> None:
             levels=parsed_args.levels,
             preserve_percentage=parsed_args.preserve_percentage,
         )
-        list_previous_update()
+        show_last_update(cache)
+        return
+
+    elif parsed_args.command == "transfer":
+        add_transfer_event(
+            donor_name=parsed_args.donor,
+            receiver_name=parsed_args.receiver,
+            retire_donor=parsed_args.retire_donor,
+        )
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "list":
-        list_current_state(parsed_args.playername, parsed_args.sortby)
+        list_current_state(parsed_args.playername, parsed_args.sortby, state=cache.state if cache else None)
         return
 
     elif parsed_args.command == "last":
-        list_previous_update()
+        show_last_update(cache)
+        return
+
+    elif parsed_args.command == "history":
+        list_event_history(parsed_args.events, parsed_args.since, parsed_args.until)
+        return
+
+    elif parsed_args.command == "timeline":
+        list_player_timeline(parsed_args.playername)
+        return
+
+    elif parsed_args.command == "simulate":
+        parties = [parse_party(party) for party in parsed_args.party]
+        if parsed_args.player or parsed_args.questlog or parsed_args.fastlog:
+            parties.insert(0, (parsed_args.player, parsed_args.questlog, parsed_args.fastlog))
+        if not parties:
+            print("No players specified. Please specify some players")
+            exit(1)
+        simulate_sessions(parsed_args.exp, parties, parsed_args.jobs, state=cache.state if cache else None)
         return
 
     elif parsed_args.command == "remove":
         add_remove_player_event(
             player_name=parsed_args.playername
         )
-        list_previous_update()
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "restore":
         add_restore_player_event(
             player_name=parsed_args.playername
         )
-        list_previous_update()
+        show_last_update(cache)
         return
 
     elif parsed_args.command == "removed":
         list_current_state(
             parsed_args.playername,
             parsed_args.sortby,
-            show_removed_instead=True
+            show_removed_instead=True,
+            state=cache.state if cache else None,
         )
         return
 
+    elif parsed_args.command == "migrate":
+        if event_database_exists():
+            print("The event database {database} already exists".format(database=campaign.event_database_file))
+            exit(1)
+        if parsed_args.sqlite:
+            source = campaign.event_log_file if os.path.exists(campaign.event_log_file) else campaign.event_source_file
+            print("Migrated {count} events from {source} to {database}".format(
+                count=migrate_event_database(),
+                source=source,
+                database=campaign.event_database_file,
+            ))
+            return
+        if os.path.exists(campaign.event_log_file):
+            print("The event log {log} already exists".format(log=campaign.event_log_file))
+            exit(1)
+        print("Migrated {count} events from {source} to {log}".format(
+            count=migrate_event_source(),
+            source=campaign.event_source_file,
+            log=campaign.event_log_file,
+        ))
+        return
+
+    elif parsed_args.command == "import":
+        import_events(parsed_args.file, parsed_args.format)
+        return
+
+    elif parsed_args.command == "export":
+        output = parsed_args.output or campaign.event_source_file
+        compact_event_log()
+        print("Exported {count} events to {output}".format(
+            count=export_event_list(output),
+            output=output,
+        ))
+        return
+
+    elif parsed_args.command == "campaigns":
+        if parsed_args.add is None and parsed_args.remove is None:
+            list_campaigns()
+            return
+        campaigns = read_campaign_registry()
+        if parsed_args.add is not None:
+            name, directory = parsed_args.add
+            if not os.path.isdir(directory):
+                print("{directory} is not a directory".format(directory=directory))
+                exit(1)
+            campaigns[name] = Campaign(name, os.path.abspath(directory))
+            print("Added campaign {name}".format(name=name))
+        if parsed_args.remove is not None:
+            if parsed_args.remove not in campaigns:
+                print("There is no campaign named {name}".format(name=parsed_args.remove))
+                exit(1)
+            del campaigns[parsed_args.remove]
+            print("Removed campaign {name}".format(name=parsed_args.remove))
+        write_campaign_registry(campaigns)
+        return
+
+    elif parsed_args.command == "refresh":
+        refresh_campaigns(parsed_args.jobs)
+        return
+
+    elif parsed_args.command == "validate":
+        validate_events()
+        return
+
+    elif parsed_args.command == "serve":
+        if cache is not None:
+            print("The daemon is already running")
+            exit(1)
+        serve()
+        return
+
     print("Error, a command must be chosen. Use --help to see commands")
 
 
+################################################################################
+# add_event
+#
+# Dates an event and appends it, as long as it is valid against the current
+# state. The current state comes from the newest snapshot, or the event
+# database, so checking an event does not replay the history.
+################################################################################
 def add_event(event: Any) -> None:
-    event_list = get_event_list()
+    event["date"] = next_event_date(last_event_date())
+
+    state, _ = replay_to()
+    errors = event_errors(event, state)
+    if errors:
+        for error in errors:
+            print("Invalid event: {error}".format(error=error))
+        exit(1)
 
+    append_events([event])
 
-    today = datetime.datetime.now()
-    event["date"] = today.strftime('%Y/%m/%d-%H:%M:%S')
 
-    event_list.append(event)
+def get_event_list() -> List[Any]:
+    return list(iter_events())
 
-    with open(EVENTSOURCE_FILE, "w") as f:
-        json.dump(event_list[::-1], f, indent=4)
 
+################################################################################
+# iter_events
+#
+# Yields every event in chronological order. The event log is streamed one
+# line at a time. The legacy EVENTSOURCE_FILE is stored newest first so it has
+# to be loaded whole before it can be reversed; running the migrate command
+# avoids that.
+################################################################################
+def iter_events() -> Iterator[Any]:
+    if event_database_exists():
+        yield from read_database_events()
+        return
 
-def get_event_list() -> List[Any]:
-    if not os.path.exists(EVENTSOURCE_FILE):
-        with open(EVENTSOURCE_FILE, "w") as f:
-            json.dump([], f)
+    if os.path.exists(campaign.event_log_file):
+        yield from read_event_log()
+        return
+
+    if not os.path.exists(campaign.event_source_file):
+        return
+
+    with profile_phase("json_load"), open(campaign.event_source_file, "r") as f:
+        eventsource: List[Any] = json.load(f)
+
+    while eventsource:
+        yield eventsource.pop()
+
+
+################################################################################
+# count_events
+#
+# Counts the events without parsing them, using the event index when there is
+# one.
+################################################################################
+def count_events() -> int:
+    if event_database_exists():
+        with contextlib.closing(connect_event_database()) as connection:
+            return count_database_events(connection)
+
+    index = open_event_index()
+    if index is not None:
+        with index:
+            return index.event_count
+
+    if os.path.exists(campaign.event_log_file):
+        count = 0
+        with open(campaign.event_log_file, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    count += 1
+        return count
+
+    if not os.path.exists(campaign.event_source_file):
+        return 0
+
+    with open(campaign.event_source_file, "r") as f:
+        return len(json.load(f))
+
+
+################################################################################
+# write_file_atomically
+#
+# Writes the contents to a temporary file and then moves it over the original
+# so that a crash part way through never leaves a partially written file.
+################################################################################
+def write_file_atomically(path: str, contents: str) -> None:
+    with profile_phase("file_write"):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    # Make sure the rename itself is persisted. Not every platform allows a
+    # directory to be opened for this so it is skipped where it fails.
+    try:
+        directory_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+################################################################################
+# read_event_log
+#
+# Yields every complete event from the event log in chronological order. A
+# final line without a trailing newline is the remains of an interrupted
+# append and is ignored.
+################################################################################
+def read_event_log() -> Iterator[Any]:
+    for event, _ in read_event_log_from(0):
+        yield event
+
+
+################################################################################
+# read_event_log_from
+#
+# Yields every complete event in the event log that starts at or after the
+# byte offset, along with the offset just past the end of the event.
+################################################################################
+def read_event_log_from(offset: int) -> Iterator[Tuple[Any, int]]:
+    with open(campaign.event_log_file, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            if profiler is not None:
+                with profiler.phase("json_load", trace=False):
+                    event = json.loads(line)
+            else:
+                event = json.loads(line)
+            yield event, offset
+
+
+def event_log_line(event: Any) -> str:
+    return json.dumps(event) + "\n"
+
+
+################################################################################
+# event_log_is_intact
+#
+# Checks if the event log ends with a complete line. Only the last byte needs
+# to be read because every append ends with a newline.
+################################################################################
+def event_log_is_intact() -> bool:
+    with open(campaign.event_log_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+################################################################################
+# append_events
+#
+# Appends events to the end of the event log and waits for them to reach the
+# disk. The log is created from EVENTSOURCE_FILE the first time it is written
+# to, and an interrupted append is cleared out before anything is added after
+# it.
+################################################################################
+def append_events(events: List[Any]) -> None:
+    if event_database_exists():
+        insert_database_events(events)
+        return
 
-    with open(EVENTSOURCE_FILE, "r") as f:
-        eventsource = json.load(f)[::-1]
+    if not os.path.exists(campaign.event_log_file):
+        migrate_event_source()
+    elif not event_log_is_intact():
+        compact_event_log()
 
-    return eventsource
+    with profile_phase("file_write"), open(campaign.event_log_file, "a") as f:
+        f.write("".join(event_log_line(event) for event in events))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+################################################################################
+# migrate_event_source
+#
+# Creates the event log from the events in EVENTSOURCE_FILE, returning how many
+# events were migrated.
+################################################################################
+def migrate_event_source() -> int:
+    events: List[Any] = []
+    if os.path.exists(campaign.event_source_file):
+        with profile_phase("json_load"), open(campaign.event_source_file, "r") as f:
+            events = json.load(f)
+        with profile_phase("reverse"):
+            events.reverse()
+
+    write_file_atomically(campaign.event_log_file, "".join(event_log_line(event) for event in events))
+    return len(events)
+
+
+################################################################################
+# compact_event_log
+#
+# Rewrites the event log with only its complete events.
+################################################################################
+def compact_event_log() -> None:
+    if not os.path.exists(campaign.event_log_file):
+        return
+
+    write_file_atomically(campaign.event_log_file, "".join(event_log_line(event) for event in read_event_log()))
+
+
+################################################################################
+# export_event_list
+#
+# Writes every event, newest first, in the same format EVENTSOURCE_FILE has
+# always used. Returns how many events were exported.
+################################################################################
+def export_event_list(path: str) -> int:
+    events = get_event_list()
+    write_file_atomically(path, json.dumps(events[::-1], indent=4))
+    return len(events)
+
+
+############################# Event Database Schema ############################
+# The optional sqlite event store. Events are stored as the same json as the   #
+# event log, with their type, date, and chained digest in indexed columns and  #
+# the players each event involves in event_players. The players table holds   #
+# the state after every event and is rewritten in the same transaction as the  #
+# events that change it, in the order the players appear in the state.         #
+################################################################################
+EVENT_DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    body TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_date ON events (date);
+CREATE INDEX IF NOT EXISTS events_type ON events (type);
+CREATE TABLE IF NOT EXISTS event_players (
+    event_id INTEGER NOT NULL REFERENCES events (id),
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS event_players_name ON event_players (name, event_id);
+CREATE TABLE IF NOT EXISTS players (
+    name TEXT PRIMARY KEY,
+    exp INTEGER NOT NULL,
+    removed INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS donors (
+    name TEXT PRIMARY KEY
+);
+"""
+
+
+def event_database_exists() -> bool:
+    return os.path.exists(campaign.event_database_file)
+
+
+################################################################################
+# connect_event_database
+#
+# Opens the event database, creating its tables if they do not exist yet. The
+# database runs in WAL mode so that readers, like the daemon, never block on a
+# write that is in progress.
+################################################################################
+def connect_event_database() -> sqlite3.Connection:
+    connection = sqlite3.connect(campaign.event_database_file)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(EVENT_DATABASE_SCHEMA)
+    return connection
+
+
+def count_database_events(connection: sqlite3.Connection) -> int:
+    count: Optional[int] = connection.execute("SELECT MAX(id) FROM events").fetchone()[0]
+    return count or 0
+
+
+def database_event_digest(connection: sqlite3.Connection, event_count: int) -> str:
+    if event_count <= 0:
+        return ""
+    digest: str = connection.execute("SELECT digest FROM events WHERE id = ?", (event_count,)).fetchone()[0]
+    return digest
+
+
+################################################################################
+# read_database_events
+#
+# Yields every event after the first start_count events in chronological order.
+################################################################################
+def read_database_events(start_count: int = 0) -> Iterator[Any]:
+    with contextlib.closing(connect_event_database()) as connection:
+        for (body,) in connection.execute("SELECT body FROM events WHERE id > ? ORDER BY id", (start_count,)):
+            yield json.loads(body)
+
+
+def read_database_state(connection: sqlite3.Connection) -> State:
+    players: Dict[str, int] = {}
+    removed_players: Dict[str, int] = {}
+    for name, exp, removed in connection.execute("SELECT name, exp, removed FROM players ORDER BY position"):
+        if removed:
+            removed_players[name] = exp
+        else:
+            players[name] = exp
+    donors = {name for (name,) in connection.execute("SELECT name FROM donors")}
+    return State(players, removed_players, donors)
+
+
+def write_database_state(connection: sqlite3.Connection, state: State) -> None:
+    connection.execute("DELETE FROM players")
+    connection.executemany("INSERT INTO players (name, exp, removed, position) VALUES (?, ?, ?, ?)", [
+        (name, exp, removed, position)
+        for position, (name, exp, removed) in enumerate(itertools.chain(
+            ((name, exp, False) for name, exp in state.players.items()),
+            ((name, exp, True) for name, exp in state.removed_players.items()),
+        ))
+    ])
+    connection.execute("DELETE FROM donors")
+    connection.executemany("INSERT INTO donors (name) VALUES (?)", [(name,) for name in sorted(state.donors)])
+
+
+################################################################################
+# insert_database_events
+#
+# Adds events to the event database and updates the players table with their
+# results in a single transaction, so the stored state always matches the
+# stored events. Each event is checked against the state left by the events
+# before it, and an event that cannot be applied raises a ValueError which
+# rolls back the whole insert. Migrated events are already part of the
+# history so they are copied without being checked.
+################################################################################
+def insert_database_events(events: List[Any], check_events: bool = True) -> None:
+    with contextlib.closing(connect_event_database()) as connection, connection:
+        state = read_database_state(connection)
+        digest = database_event_digest(connection, count_database_events(connection))
+
+        for event in events:
+            errors = event_errors(event, state) if check_events else []
+            if errors:
+                raise ValueError("Invalid event: {errors} {event}".format(errors=", ".join(errors), event=event))
+
+            digest = event_digest(digest, event)
+            cursor = connection.execute(
+                "INSERT INTO events (date, type, body, digest) VALUES (?, ?, ?, ?)",
+                (event.get("date", ""), event["type"], json.dumps(event), digest),
+            )
+            connection.executemany(
+                "INSERT INTO event_players (event_id, name) VALUES (?, ?)",
+                [(cursor.lastrowid, name) for name in dict.fromkeys(event_player_names(event))],
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                process_event(event, state, render=False)
+
+        write_database_state(connection, state)
+
+
+################################################################################
+# migrate_event_database
+#
+# Creates the event database from the events in the event log, or in
+# EVENTSOURCE_FILE if there is no log yet, returning how many events were
+# migrated. Once the database exists it is used instead of either file.
+################################################################################
+def migrate_event_database() -> int:
+    events = get_event_list()
+    insert_database_events(events, check_events=False)
+    return len(events)
+
+
+################################################################################
+# replay_database_to
+#
+# The event database version of replay_to. The state after every event is
+# read straight from the players table. Earlier states are replayed from the
+# newest snapshot whose digest matches the digest stored with its event.
+################################################################################
+def replay_database_to(event_count: Optional[int] = None) -> Tuple[State, Iterator[Any]]:
+    with contextlib.closing(connect_event_database()) as connection:
+        total_count = count_database_events(connection)
+        if event_count is None or event_count >= total_count:
+            return read_database_state(connection), iter(())
+
+        snapshots = list_snapshots()
+        start_count = 0
+        for snapshot_count in sorted(snapshots, reverse=True):
+            if snapshot_count > total_count:
+                remove_snapshot(snapshot_count, snapshots[snapshot_count])
+            elif snapshot_count <= event_count and snapshots[snapshot_count] == database_event_digest(connection, snapshot_count):
+                start_count = snapshot_count
+                break
+
+        start_state = None
+        if start_count > 0:
+            start_state = load_snapshot(start_count, snapshots[start_count])
+        start_digest = database_event_digest(connection, start_count)
+
+    events = read_database_events(start_count)
+    state = replay_events(((event, None) for event in events), event_count, start_count, start_digest, start_state)
+    return state, events
+
+
+################################################################################
+# count_database_events_before
+#
+# The event database version of find_event_by_date, using the index on the
+# date column.
+################################################################################
+def count_database_events_before(date: str, total_count: int, after: bool) -> int:
+    with contextlib.closing(connect_event_database()) as connection:
+        if after:
+            # Every date that starts with the given date sorts before this
+            count: int = connection.execute("SELECT COUNT(*) FROM events WHERE date < ?", (date + "\U0010ffff",)).fetchone()[0]
+        else:
+            count = connection.execute("SELECT COUNT(*) FROM events WHERE date < ?", (date,)).fetchone()[0]
+    return min(count, total_count)
+
+
+################################################################################
+# event_digest
+#
+# Chains the digest of all the previous events with the next event. A snapshot
+# stores the digest of the events it was built from, so any change to an
+# earlier event invalidates every snapshot taken after it.
+################################################################################
+def event_digest(previous_digest: str, event: Any) -> str:
+    serialized_event = json.dumps(event, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256((previous_digest + serialized_event).encode("utf-8")).hexdigest()
+
+
+def snapshot_path(event_count: int, digest: str) -> str:
+    return os.path.join(campaign.snapshot_dir, "{event_count:09d}-{digest}.json".format(
+        event_count=event_count,
+        digest=digest,
+    ))
+
+
+################################################################################
+# list_snapshots
+#
+# Returns a map of the event count of each stored snapshot to the digest of the
+# events it was built from. Both are read from the filename so that finding a
+# valid snapshot does not require opening every snapshot file.
+################################################################################
+def list_snapshots() -> Dict[int, str]:
+    if not os.path.isdir(campaign.snapshot_dir):
+        return {}
+
+    snapshots: Dict[int, str] = {}
+    for filename in os.listdir(campaign.snapshot_dir):
+        name, extension = os.path.splitext(filename)
+        event_count, _, digest = name.partition("-")
+        if extension != ".json" or not event_count.isdigit() or not digest:
+            continue
+        snapshots[int(event_count)] = digest
+    return snapshots
+
+
+def read_snapshot(event_count: int, digest: str) -> Any:
+    with profile_phase("snapshot_load"), open(snapshot_path(event_count, digest), "r") as f:
+        snapshot = json.load(f)
+
+    # Mark the snapshot as recently used so it is the last to be evicted
+    try:
+        os.utime(snapshot_path(event_count, digest))
+    except OSError:
+        pass
+
+    return snapshot
+
+
+def load_snapshot(event_count: int, digest: str) -> State:
+    return snapshot_state(read_snapshot(event_count, digest))
+
+
+def snapshot_state(snapshot: Any) -> State:
+    return State(snapshot["players"], snapshot["removed_players"], set(snapshot.get("donors", [])))
+
+
+################################################################################
+# save_snapshot
+#
+# Writes the state after the first event_count events. No random number state
+# is stored because every sessionexp event reseeds the generator with its own
+# date before rolling. When the events came from the event log, the offset
+# just past them and a digest of the log before that offset are stored too,
+# so that replay can carry on from the offset without reading the events
+# before it, along with the size and modified time of the log. Snapshots are
+# only a cache, so failing to write one is not an error.
+################################################################################
+def save_snapshot(state: State, event_count: int, digest: str, log_offset: Optional[int] = None) -> None:
+    snapshot: Dict[str, Any] = {
+        "event_count": event_count,
+        "digest": digest,
+        "players": state.players,
+        "removed_players": state.removed_players,
+        "donors": sorted(state.donors),
+    }
+    if log_offset is not None:
+        snapshot["log_offset"] = log_offset
+        snapshot["log_tail_digest"] = event_log_tail_digest(log_offset)
+
+    try:
+        if log_offset is not None:
+            log_stat = os.stat(campaign.event_log_file)
+            snapshot["log_size"] = log_stat.st_size
+            snapshot["log_modified_time"] = log_stat.st_mtime_ns
+        os.makedirs(campaign.snapshot_dir, exist_ok=True)
+        write_file_atomically(snapshot_path(event_count, digest), json.dumps(snapshot))
+    except OSError:
+        pass
+
+
+################################################################################
+# event_log_tail_digest
+#
+# A hash of the EVENT_LOG_TAIL_BYTES of the event log before the offset, used
+# to notice when the log a snapshot was taken from has been rewritten. Returns
+# None if the log is shorter than the offset.
+################################################################################
+def event_log_tail_digest(offset: int) -> Optional[str]:
+    start = max(offset - EVENT_LOG_TAIL_BYTES, 0)
+    try:
+        with open(campaign.event_log_file, "rb") as f:
+            f.seek(start)
+            tail = f.read(offset - start)
+    except OSError:
+        return None
+
+    if len(tail) != offset - start:
+        return None
+    return hashlib.sha256(tail).hexdigest()
+
+
+################################################################################
+# find_event_log_snapshot
+#
+# Finds the newest snapshot, at or before event_count, that was taken from the
+# event log as it is now. Returns its event count and the snapshot, or 0 and
+# None if there is no such snapshot. If the log is the same size as when a
+# snapshot was taken but has been modified since, an event was edited in place
+# somewhere in the log, so that snapshot is removed and none of the snapshots
+# are used.
+################################################################################
+def find_event_log_snapshot(event_count: Optional[int]) -> Tuple[int, Any]:
+    try:
+        log_stat = os.stat(campaign.event_log_file)
+    except OSError:
+        return 0, None
+
+    snapshots = list_snapshots()
+    for snapshot_count in sorted(snapshots, reverse=True):
+        if event_count is not None and snapshot_count > event_count:
+            continue
+        try:
+            snapshot = read_snapshot(snapshot_count, snapshots[snapshot_count])
+        except (OSError, ValueError):
+            continue
+        if "log_modified_time" not in snapshot:
+            continue
+        if snapshot["log_size"] == log_stat.st_size and snapshot["log_modified_time"] != log_stat.st_mtime_ns:
+            remove_snapshot(snapshot_count, snapshots[snapshot_count])
+            return 0, None
+        if snapshot["log_tail_digest"] == event_log_tail_digest(snapshot["log_offset"]):
+            return snapshot_count, snapshot
+    return 0, None
+
+
+def remove_snapshot(event_count: int, digest: str) -> None:
+    try:
+        os.remove(snapshot_path(event_count, digest))
+    except OSError:
+        pass
+
+
+################################################################################
+# prune_snapshots
+#
+# Removes the oldest snapshots that were not taken on a SNAPSHOT_INTERVAL
+# boundary, leaving at most SNAPSHOT_TAIL_LIMIT of them, and then the least
+# recently used interval snapshots past SNAPSHOT_CACHE_LIMIT.
+################################################################################
+def prune_snapshots() -> None:
+    snapshots = list_snapshots()
+    tail_snapshots = sorted(
+        event_count for event_count in snapshots
+        if event_count % SNAPSHOT_INTERVAL != 0
+    )
+    for event_count in tail_snapshots[:-SNAPSHOT_TAIL_LIMIT]:
+        remove_snapshot(event_count, snapshots[event_count])
+
+    interval_snapshots = [event_count for event_count in snapshots if event_count % SNAPSHOT_INTERVAL == 0]
+    if len(interval_snapshots) <= SNAPSHOT_CACHE_LIMIT:
+        return
+
+    last_used: Dict[int, float] = {}
+    for event_count in interval_snapshots:
+        try:
+            last_used[event_count] = os.stat(snapshot_path(event_count, snapshots[event_count])).st_mtime
+        except OSError:
+            pass
+    least_recently_used = sorted(last_used, key=lambda event_count: (last_used[event_count], event_count))
+    for event_count in least_recently_used[:len(least_recently_used) - SNAPSHOT_CACHE_LIMIT]:
+        remove_snapshot(event_count, snapshots[event_count])
+
+
+################################################################################
+# replay_events
+#
+# Builds the state after the first event_count events, or after every event if
+# event_count is None. Replay starts from the newest snapshot whose digest
+# still matches the events, so only the events after that snapshot are
+# processed. Events are buffered only until the next snapshot that could still
+# be valid, so memory use is bounded by the distance between snapshots rather
+# than by the length of the history. Snapshots that no longer match are
+# removed, and new ones are saved along the way.
+#
+# To continue from a known point, events can start after the first start_count
+# events, whose digest is start_digest, with start_state being the state after
+# them.
+#
+# Each event comes with the event log offset just past it, or None if it did
+# not come from the event log. The events iterator is left positioned just
+# after the last replayed event.
+################################################################################
+def replay_events(
+    events: Iterator[Tuple[Any, Optional[int]]],
+    event_count: Optional[int] = None,
+    start_count: int = 0,
+    start_digest: str = "",
+    start_state: Optional[State] = None,
+) -> State:
+    snapshots = list_snapshots()
+    candidates = sorted(
+        snapshot_count for snapshot_count in snapshots
+        if start_count < snapshot_count and (event_count is None or snapshot_count <= event_count)
+    )
+    next_candidate = 0
+
+    state = State() if start_state is None else start_state
+    pending_events: List[Tuple[int, Any, str, Optional[int]]] = []
+
+    def process_pending_events() -> None:
+        for pending_count, pending_event, pending_digest, pending_offset in pending_events:
+            process_event(pending_event, state, render=False)
+            if pending_count % SNAPSHOT_INTERVAL == 0 and pending_count not in snapshots:
+                save_snapshot(state, pending_count, pending_digest, pending_offset)
+                snapshots[pending_count] = pending_digest
+        pending_events.clear()
+
+    digest = start_digest
+    count = start_count
+    offset: Optional[int] = None
+    for event, offset in itertools.islice(events, None if event_count is None else event_count - start_count):
+        digest = event_digest(digest, event)
+        count += 1
+
+        while next_candidate < len(candidates) and candidates[next_candidate] < count:
+            next_candidate += 1
+
+        if next_candidate < len(candidates) and candidates[next_candidate] == count:
+            next_candidate += 1
+            if snapshots[count] == digest:
+                pending_events.clear()
+                state = load_snapshot(count, digest)
+                continue
+            remove_snapshot(count, snapshots[count])
+            del snapshots[count]
+
+        pending_events.append((count, event, digest, offset))
+
+        if next_candidate == len(candidates):
+            process_pending_events()
+
+    process_pending_events()
+
+    # Snapshots past the end of a full replay were built from events that no
+    # longer exist.
+    if event_count is None:
+        for snapshot_count in candidates[next_candidate:]:
+            if snapshot_count in snapshots:
+                remove_snapshot(snapshot_count, snapshots[snapshot_count])
+
+    if count > 0 and count not in snapshots:
+        save_snapshot(state, count, digest, offset)
+
+    prune_snapshots()
+    return state
+
+
+############################## Event Index Format ##############################
+# The index file starts with a header recording which event log it indexes and #
+# how much of it, followed by one record per event with the byte offset the    #
+# event starts at and the digest of every event up to and including it.       #
+################################################################################
+EVENT_INDEX_MAGIC = b"SHEXIDX2"
+EVENT_INDEX_HEADER = struct.Struct("<8sQQQQQ32s")  # magic, device, inode, modified time, indexed size, event count, tail digest
+EVENT_INDEX_RECORD = struct.Struct("<Q32s")  # event offset, event digest
+
+
+################################################################################
+# EventIndex
+#
+# An open event index. Records are read from the file as they are needed so
+# opening the index does not depend on the length of the log.
+################################################################################
+class EventIndex:
+    def __init__(self, index_file: BinaryIO) -> None:
+        self._file = index_file
+        self.event_count = 0
+        self.indexed_size = 0
+
+    def __enter__(self) -> "EventIndex":
+        return self
+
+    def __exit__(self, *exception: Any) -> None:
+        self._file.close()
+
+    # The offset of the event after the first event_count events
+    def offset(self, event_count: int) -> int:
+        if event_count >= self.event_count:
+            return self.indexed_size
+        return self._record(event_count)[0]
+
+    # The digest of the first event_count events
+    def digest(self, event_count: int) -> str:
+        if event_count <= 0:
+            return ""
+        return self._record(event_count - 1)[1].hex()
+
+    def _record(self, event_number: int) -> Tuple[int, bytes]:
+        self._file.seek(EVENT_INDEX_HEADER.size + event_number * EVENT_INDEX_RECORD.size)
+        record: Tuple[int, bytes] = EVENT_INDEX_RECORD.unpack(self._file.read(EVENT_INDEX_RECORD.size))
+        return record
+
+    ############################################################################
+    # update
+    #
+    # Indexes any events appended to the log since the index was last updated.
+    # The index is rebuilt from the start if it belongs to a different log file,
+    # if the log is now shorter than the indexed part, if the last indexed
+    # event no longer matches, which is what rewriting the log looks like, or
+    # if the log has been modified without changing size, which is what editing
+    # an event in place looks like.
+    ############################################################################
+    def update(self) -> None:
+        log_stat = os.stat(campaign.event_log_file)
+
+        self._file.seek(0)
+        header = self._file.read(EVENT_INDEX_HEADER.size)
+        if len(header) == EVENT_INDEX_HEADER.size:
+            magic, device, inode, modified_time, indexed_size, event_count, tail_digest = EVENT_INDEX_HEADER.unpack(header)
+            self.event_count = event_count
+            self.indexed_size = indexed_size
+            if (
+                magic != EVENT_INDEX_MAGIC
+                or (device, inode) != (log_stat.st_dev, log_stat.st_ino)
+                or indexed_size > log_stat.st_size
+                or (indexed_size == log_stat.st_size and modified_time != log_stat.st_mtime_ns)
+                or not self.has_tail_digest(tail_digest)
+            ):
+                self.event_count = 0
+                self.indexed_size = 0
+
+        if self.indexed_size == log_stat.st_size and len(header) == EVENT_INDEX_HEADER.size:
+            return
+
+        records: List[bytes] = []
+        digest = self.digest(self.event_count)
+        with open(campaign.event_log_file, "rb") as log:
+            log.seek(self.indexed_size)
+            for line in log:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    digest = event_digest(digest, json.loads(line))
+                    records.append(EVENT_INDEX_RECORD.pack(self.indexed_size, bytes.fromhex(digest)))
+                self.indexed_size += len(line)
+
+        self._file.seek(EVENT_INDEX_HEADER.size + self.event_count * EVENT_INDEX_RECORD.size)
+        self._file.write(b"".join(records))
+        self._file.truncate()
+        self.event_count += len(records)
+
+        header = EVENT_INDEX_HEADER.pack(
+            EVENT_INDEX_MAGIC,
+            log_stat.st_dev,
+            log_stat.st_ino,
+            log_stat.st_mtime_ns,
+            self.indexed_size,
+            self.event_count,
+            self.tail_digest(),
+        )
+        self._file.seek(0)
+        self._file.write(header)
+        self._file.flush()
+
+    def has_tail_digest(self, tail_digest: bytes) -> bool:
+        try:
+            return self.tail_digest() == tail_digest
+        except struct.error:
+            # The index file is shorter than its header says
+            return False
+
+    # A hash of the log from the start of the last indexed event to the end of
+    # the indexed part, used to notice when the log has been rewritten.
+    def tail_digest(self) -> bytes:
+        start = self.offset(self.event_count - 1) if self.event_count > 0 else 0
+        with open(campaign.event_log_file, "rb") as log:
+            log.seek(start)
+            return hashlib.sha256(log.read(self.indexed_size - start)).digest()
+
+
+################################################################################
+# open_event_index
+#
+# Opens the event index, bringing it up to date with the event log first.
+# Returns None when there is no event log, when the events are kept in the
+# event database instead, or when the index cannot be written, in which case
+# the events have to be read from the start.
+################################################################################
+def open_event_index() -> Optional[EventIndex]:
+    if event_database_exists() or not os.path.exists(campaign.event_log_file):
+        return None
+
+    try:
+        index = EventIndex(open(campaign.event_index_file, "r+b" if os.path.exists(campaign.event_index_file) else "w+b"))
+    except OSError:
+        return None
+
+    try:
+        with profile_phase("index_update"):
+            index.update()
+    except (OSError, struct.error):
+        index.__exit__()
+        return None
+    return index
+
+
+################################################################################
+# event_log_offset
+#
+# The byte offset in the event log of the event after the first event_count
+# events.
+################################################################################
+def event_log_offset(event_count: int) -> int:
+    index = open_event_index()
+    if index is not None:
+        with index:
+            return index.offset(event_count)
+
+    offset = 0
+    for i, (_, end_offset) in enumerate(read_event_log_from(0)):
+        if i == event_count:
+            break
+        offset = end_offset
+    return offset
+
+
+################################################################################
+# replay_to
+#
+# Returns the state after the first event_count events, or after every event
+# if event_count is None, along with an iterator over the events after them.
+# With the event index the newest valid snapshot is found by comparing digests
+# from the index, and the log is read from that snapshot's event onwards, so
+# the cost depends only on the distance from that snapshot.
+################################################################################
+def replay_to(event_count: Optional[int] = None) -> Tuple[State, Iterator[Any]]:
+    if event_database_exists():
+        return replay_database_to(event_count)
+
+    index = open_event_index()
+    if index is None and not os.path.exists(campaign.event_log_file):
+        events = iter_events()
+        return replay_events(((event, None) for event in events), event_count), events
+
+    # Without an index, replay carries on from the offset stored in the newest
+    # snapshot that still matches the log.
+    if index is None:
+        start_count, snapshot = find_event_log_snapshot(event_count)
+        if snapshot is None:
+            log_events = read_event_log_from(0)
+            return replay_events(log_events, event_count), (event for event, _ in log_events)
+
+        log_events = read_event_log_from(snapshot["log_offset"])
+        state = replay_events(log_events, event_count, start_count, snapshot["digest"], snapshot_state(snapshot))
+        return state, (event for event, _ in log_events)
+
+    with index:
+        if event_count is None or event_count > index.event_count:
+            event_count = index.event_count
+
+        snapshots = list_snapshots()
+        start_count = 0
+        for snapshot_count in sorted(snapshots, reverse=True):
+            if snapshot_count > index.event_count:
+                remove_snapshot(snapshot_count, snapshots[snapshot_count])
+            elif snapshot_count <= event_count and snapshots[snapshot_count] == index.digest(snapshot_count):
+                start_count = snapshot_count
+                break
+
+        start_state = None
+        if start_count > 0:
+            start_state = load_snapshot(start_count, snapshots[start_count])
+
+        start_digest = index.digest(start_count)
+        start_offset = index.offset(start_count)
+
+    log_events = read_event_log_from(start_offset)
+    state = replay_events(log_events, event_count, start_count, start_digest, start_state)
+    return state, (event for event, _ in log_events)
+
+
+################################################################################
+# find_event_by_date
+#
+# Counts the events dated before the given date, or with after set, the events
+# dated on or before it. Events are appended in date order, so with the event
+# index this is a binary search that only reads a handful of events.
+################################################################################
+def find_event_by_date(date: str, total_count: int, after: bool) -> int:
+    def is_before(event: Any) -> bool:
+        event_date = event.get("date", "")
+        if after:
+            return bool(event_date[:len(date)] <= date)
+        return bool(event_date < date)
+
+    if event_database_exists():
+        return count_database_events_before(date, total_count, after)
+
+    index = open_event_index()
+    if index is None:
+        return sum(1 for event in iter_events() if is_before(event))
+
+    with index, open(campaign.event_log_file, "rb") as log:
+        low, high = 0, min(total_count, index.event_count)
+        while low < high:
+            middle = (low + high) // 2
+            log.seek(index.offset(middle))
+            if is_before(json.loads(log.readline())):
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
 
 def add_exp_event(
@@ -281,8 +1938,6 @@ def add_exp_event(
     questlog_players: List[str],
     fastlog_players: List[str]
 ) -> None:
-    # TODO: Validate that the players present actually exist
-
     if len(attending_players) + len(questlog_players) + len(fastlog_players) < 1:
         print("No players specified. Please specify some players")
         exit(1)
@@ -299,7 +1954,6 @@ def add_new_player_event(
     player_name: str,
     starting_exp: int
 ) -> None:
-    # TODO: Validate that this player does not already exist
     add_event({
         "type": "newplayer",
         "name": player_name,
@@ -310,7 +1964,6 @@ def add_bonus_exp_event(
     player_name: str,
     bonus_exp: int
 ) -> None:
-    # TODO: Validate that this player exists
     add_event({
         "type": "bonusexp",
         "name": player_name,
@@ -322,7 +1975,6 @@ def add_levelup_event(
     levels: int,
     preserve_percentage: bool,
 ) -> None:
-    # TODO: Validate that this player exists
     add_event({
         "type": "levelup",
         "name": player_name,
@@ -331,61 +1983,334 @@ def add_levelup_event(
     })
 
 
-def add_remove_player_event(
-    player_name: str,
-) -> None:
-    # TODO: Validate the player exists
-    add_event({
-        "type": "removeplayer",
-        "name": player_name,
-    })
+def add_remove_player_event(
+    player_name: str,
+) -> None:
+    add_event({
+        "type": "removeplayer",
+        "name": player_name,
+    })
+
+
+def add_restore_player_event(
+    player_name: str,
+) -> None:
+    add_event({
+        "type": "restoreplayer",
+        "name": player_name,
+    })
+
+
+def add_transfer_event(
+    donor_name: str,
+    receiver_name: str,
+    retire_donor: bool,
+) -> None:
+    add_event({
+        "type": "transfer",
+        "donor": donor_name,
+        "receiver": receiver_name,
+        "retire_donor": retire_donor,
+    })
+
+
+################################################################################
+# read_import_file
+#
+# Reads the events to import from a jsonl file, with one event object per line,
+# or from a csv file with a "type" column and the columns in import_csv_fields.
+# Each event comes with the errors from reading it. A line that is not json, or
+# a cell that cannot be read, is kept as its raw text so it can be reported
+# along with the events that fail validation.
+################################################################################
+def read_import_file(path: str, file_format: Optional[str] = None) -> List[Tuple[Any, List[str]]]:
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+    events: List[Tuple[Any, List[str]]] = []
+    with open(path, "r", newline="") as f:
+        if file_format == "jsonl":
+            for line in f:
+                if line.strip():
+                    try:
+                        events.append((json.loads(line), []))
+                    except json.JSONDecodeError as e:
+                        events.append((line.strip(), ["Line is not valid json, {error}".format(error=e)]))
+            return events
+
+        for row in csv.DictReader(f):
+            event_type = (row.get("type") or "").strip()
+            event: Dict[str, Any] = {"type": event_type}
+            errors: List[str] = []
+            for field, parse in import_csv_fields.get(event_type, {}).items():
+                cell = row.get(field) or ""
+                if cell.strip() == "" and parse is not split_players:
+                    continue
+                try:
+                    event[field] = parse(cell)
+                except ValueError:
+                    errors.append("{field} could not be read from {cell!r}".format(field=field, cell=cell))
+            if (row.get("date") or "").strip():
+                event["date"] = row["date"].strip()
+            events.append((row if errors else event, errors))
+
+    return events
+
+
+################################################################################
+# event_errors
+#
+# Lists the reasons an event could not be applied to the state. An empty list
+# means the event is valid. The event is checked against the schema first and
+# then against the state, looking only at the players the event names, so the
+# cost depends on the size of the event rather than the size of the state.
+################################################################################
+def event_errors(event: Any, state: State) -> List[str]:
+    event_type = event.get("type") if isinstance(event, dict) else None
+    if event_type not in event_validators:
+        return ["Unknown event type {event_type}".format(event_type=event_type)]
+
+    errors = event_validators[event_type](event)
+    if errors:
+        return errors
+
+    if event_type == "sessionexp":
+        session_players = event["players"] + event["questlog_players"] + event["fastlog_players"]
+        if len(session_players) < 1:
+            errors.append("No players specified")
+        for player in session_players:
+            if player not in state.players:
+                errors.append("Player {player} does not exist".format(player=player))
+        for player, count in collections.Counter(session_players).items():
+            if count > 1:
+                errors.append("Player {player} is listed more than once".format(player=player))
+
+    elif event_type == "newplayer":
+        if event["name"] in state.players:
+            errors.append("Player {name} already exists".format(name=event["name"]))
+        elif event["name"] in state.removed_players:
+            errors.append("Player {name} was removed, restore them instead".format(name=event["name"]))
+
+    elif event_type in ["bonusexp", "levelup", "removeplayer"]:
+        if event["name"] not in state.players:
+            errors.append("Player {name} does not exist".format(name=event["name"]))
+        elif event_type == "levelup":
+            target_level = get_level_from_exp(state.players[event["name"]]) + event["levels"]
+            if event["levels"] < 1:
+                errors.append("Levelup levels less than 1")
+            elif target_level > MAX_LEVEL or (target_level == MAX_LEVEL and event["preserve_percentage"]):
+                errors.append("Levelup would exceed max")
+
+    elif event_type == "restoreplayer":
+        if event["name"] not in state.removed_players:
+            errors.append("Player {name} is not a removed player".format(name=event["name"]))
+
+    elif event_type == "transfer":
+        if event["donor"] not in state.players and event["donor"] not in state.removed_players:
+            errors.append("Player {donor} does not exist".format(donor=event["donor"]))
+        if event["receiver"] not in state.players:
+            errors.append("Player {receiver} does not exist".format(receiver=event["receiver"]))
+        if event["donor"] == event["receiver"]:
+            errors.append("Player {donor} cannot transfer exp to themselves".format(donor=event["donor"]))
+        if event["donor"] in state.donors:
+            errors.append("Player {donor} has already given their exp".format(donor=event["donor"]))
+
+    return errors
+
+
+################################################################################
+# validate_events
+#
+# Checks every event in one streaming pass, applying each valid event to the
+# state so the next event is checked against the state it would be replayed
+# against. Invalid events are reported and left out of the state.
+################################################################################
+def validate_events() -> None:
+    state = State()
+    event_count = 0
+    error_count = 0
+    for event_count, event in enumerate(iter_events(), 1):
+        errors = event_errors(event, state)
+        for error in errors:
+            print("Event {n} ({date}): {error}".format(
+                n=event_count,
+                date=event.get("date", "undated") if isinstance(event, dict) else "undated",
+                error=error,
+            ))
+        error_count += len(errors)
+        if errors:
+            continue
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_event(event, state, render=False)
+
+    print("Checked {count} events and found {errors} errors".format(count=event_count, errors=error_count))
+    if error_count > 0:
+        exit(1)
+
+
+################################################################################
+# import_events
+#
+# Adds every event in an import file with a single write to the event log. The
+# events are validated and applied to the current state one at a time, so each
+# event is checked against the state left by the events before it, and the
+# output of each event comes from that same pass. Nothing is written if any
+# event is invalid. Events without a date are dated with next_event_date, since
+# quest log gold is rolled from the date of the session, and events dated
+# before the event they follow are refused so the log stays in order.
+################################################################################
+def import_events(path: str, file_format: Optional[str] = None) -> None:
+    import_rows = read_import_file(path, file_format)
+    events = [event for event, _ in import_rows]
+    if len(events) == 0:
+        print("No events found in {path}".format(path=path))
+        exit(1)
+
+    existing_count = count_events()
+    previous_date = last_event_date()
+    state, _ = replay_to()
+
+    error_lines: List[str] = []
+    output_lines: List[str] = []
+    for i, (event, read_errors) in enumerate(import_rows):
+        errors = read_errors or event_errors(event, state)
+        if not errors:
+            if "date" not in event:
+                event["date"] = next_event_date(previous_date)
+            if event["date"] < previous_date:
+                errors.append("Date {date} is before the event before it at {previous_date}".format(date=event["date"], previous_date=previous_date))
+            else:
+                previous_date = event["date"]
+        if errors:
+            for error in errors:
+                error_lines.append("Import event {n}: {error} {event}".format(n=i+1, error=error, event=event))
+            continue
+
+        output_string = "Showing the result of event {n} of {total_count} events.".format(
+            n=existing_count+i+1,
+            total_count=existing_count+len(events))
+        output_lines.append(output_string)
+        output_lines.append("="*len(output_string))
+        output_lines += process_event(event, state)
+        output_lines.append("")
+
+    if error_lines:
+        print("\n".join(error_lines))
+        print("No events were imported")
+        exit(1)
+
+    append_events(events)
+
+    print("\n".join(output_lines))
+
+
+################################################################################
+# next_event_date
+#
+# Dates a new event now, or a second after the event before it when that event
+# is dated now or later, so that every event is dated after the one before it
+# and find_event_by_date can search the history by date.
+################################################################################
+def next_event_date(previous_date: str) -> str:
+    date = datetime.datetime.now().replace(microsecond=0)
+    try:
+        date = max(date, datetime.datetime.strptime(previous_date, '%Y/%m/%d-%H:%M:%S') + datetime.timedelta(seconds=1))
+    except ValueError:
+        pass
+    return date.strftime('%Y/%m/%d-%H:%M:%S')
 
 
-def add_restore_player_event(
-    player_name: str,
-) -> None:
-    add_event({
-        "type": "restoreplayer",
-        "name": player_name,
-    })
+def last_event_date() -> str:
+    event_count = count_events()
+    if event_count == 0:
+        return ""
 
+    _, events = replay_to(event_count - 1)
+    date: str = next(events).get("date", "")
+    return date
 
-def list_previous_update(n=0) -> None:
-    events = get_event_list()
+
+def list_previous_update(n: int = 0) -> None:
+    total_count = count_events()
 
     if n <= 0:
-        n = len(events)+n
+        n = total_count+n
 
-    output_string = "Showing the result of event {n} of {total_count} events.".format(
-        n=n,
-        total_count=len(events))
-    print(output_string)
-    print("="*len(output_string))
+    list_event_updates(n, n, total_count)
 
-    state = State()
-    for event in events[:n-1]:
-        process_event(event, state)
 
-    print("\n".join(process_event(events[n-1], state)))
+################################################################################
+# list_event_updates
+#
+# Prints the result of every event from first to last, counting from 1. Only
+# the events since the snapshot before the first event need to be replayed.
+################################################################################
+def list_event_updates(first: int, last: int, total_count: int) -> None:
+    state, events = replay_to(first-1)
+
+    for n in range(first, last+1):
+        output_string = "Showing the result of event {n} of {total_count} events.".format(
+            n=n,
+            total_count=total_count)
+        print(output_string)
+        print("="*len(output_string))
+
+        print("\n".join(process_event(next(events), state)))
+
+
+################################################################################
+# list_event_history
+#
+# Prints the result of each numbered event, and of every event between the
+# since and until dates. Dates are compared as text, so a date can be cut short
+# to match a whole day or month.
+################################################################################
+def list_event_history(event_numbers: List[int], since: Optional[str], until: Optional[str]) -> None:
+    total_count = count_events()
+
+    for n in event_numbers:
+        if n <= 0:
+            n = total_count+n
+        if n < 1 or n > total_count:
+            print("There is no event {n}, there are {total_count} events.".format(n=n, total_count=total_count))
+            exit(1)
+        list_event_updates(n, n, total_count)
+
+    if since is None and until is None:
+        if not event_numbers:
+            print("Choose events to show by number or with --since and --until")
+            exit(1)
+        return
+
+    first = 1
+    if since is not None:
+        first = find_event_by_date(since, total_count, after=False) + 1
+    last = total_count
+    if until is not None:
+        last = find_event_by_date(until, total_count, after=True)
+
+    if first > last:
+        print("No events found between {since} and {until}".format(since=since or "the start", until=until or "the end"))
+        return
+
+    list_event_updates(first, last, total_count)
 
 
 def list_current_state(
     filter_player: str="",
     sortby: str="",
     show_removed_instead: bool=False,
+    state: Optional[State]=None,
 ) -> None:
-    events = get_event_list()
-
-    state = State()
-
-    for event in events:
-        process_event(event, state)
+    if state is None:
+        state, _ = replay_to()
 
     players = state.players
     if show_removed_instead:
         players = state.removed_players
 
-    player_iter = players.keys()
+    player_iter: Iterable[str] = players.keys()
     if sortby == "exp":
         player_iter = sorted(player_iter, key=lambda name: players[name])
     elif sortby == "name":
@@ -410,6 +2335,538 @@ def list_current_state(
         ))
 
 
+################################################################################
+# event_player_names
+#
+# The names of every player an event could change.
+################################################################################
+def event_player_names(event: Any) -> List[str]:
+    if event.get("type") == "sessionexp":
+        names: List[str] = event["players"] + event["questlog_players"] + event["fastlog_players"]
+        return names
+    if event.get("type") == "transfer":
+        return [event["donor"], event["receiver"]]
+    if "name" in event:
+        return [event["name"]]
+    return []
+
+
+def player_exp(state: State, name: str) -> Optional[int]:
+    if name in state.players:
+        return state.players[name]
+    return state.removed_players.get(name)
+
+
+################################################################################
+# timeline_changes
+#
+# Processes an event and returns a timeline entry for each player it changed,
+# recording how much exp they gained and what they ended up with.
+################################################################################
+def timeline_changes(event: Any, event_number: int, state: State) -> Dict[str, Any]:
+    names = event_player_names(event)
+    exp_before = {name: player_exp(state, name) for name in names}
+
+    process_event(event, state, render=False)
+
+    changes: Dict[str, Any] = {}
+    for name in names:
+        exp_after = player_exp(state, name)
+        if exp_after is None:
+            continue
+        changes[name] = {
+            "event": event_number,
+            "date": event.get("date", ""),
+            "type": event["type"],
+            "exp_change": exp_after - (exp_before[name] or 0),
+            "exp": exp_after,
+            "removed": name in state.removed_players,
+        }
+    return changes
+
+
+def timeline_path(name: str) -> str:
+    return os.path.join(campaign.timeline_dir, urllib.parse.quote(name, safe="") + ".jsonl")
+
+
+def timeline_index_path() -> str:
+    return os.path.join(campaign.timeline_dir, "index.json")
+
+
+################################################################################
+# read_timeline
+#
+# Reads a player's timeline entries for the first event_count events. Entries
+# past event_count, or repeated by an update that was interrupted before it
+# finished, are skipped.
+################################################################################
+def read_timeline(name: str, event_count: int) -> List[Any]:
+    entries: List[Any] = []
+    if not os.path.exists(timeline_path(name)):
+        return entries
+
+    with open(timeline_path(name), "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            entry = json.loads(line)
+            if entry["event"] > event_count:
+                break
+            if entries and entry["event"] <= entries[-1]["event"]:
+                continue
+            entries.append(entry)
+    return entries
+
+
+################################################################################
+# update_timeline_index
+#
+# Brings the per-player timeline index up to date and returns how many events
+# it covers. Each player's entries are kept in their own file so that looking
+# at one player only reads the entries for that player. The index is checked
+# against the digests in the event database, or in the event index, and is
+# rebuilt if the events it was built from have changed. Without either there
+# is nothing to check it against so nothing is stored.
+################################################################################
+def update_timeline_index() -> Tuple[int, Dict[str, List[Any]]]:
+    if event_database_exists():
+        with contextlib.closing(connect_event_database()) as connection:
+            event_count = count_database_events(connection)
+            timeline_count = read_timeline_index(event_count, lambda count: database_event_digest(connection, count))
+            digest = database_event_digest(connection, event_count)
+    else:
+        index = open_event_index()
+        if index is None:
+            timelines: Dict[str, List[Any]] = {}
+            state = State()
+            event_number = 0
+            for event_number, event in enumerate(iter_events(), 1):
+                for name, entry in timeline_changes(event, event_number, state).items():
+                    timelines.setdefault(name, []).append(entry)
+            return event_number, timelines
+
+        with index:
+            event_count = index.event_count
+            timeline_count = read_timeline_index(event_count, index.digest)
+            digest = index.digest(event_count)
+
+    if timeline_count == event_count:
+        return event_count, {}
+
+    state, events = replay_to(timeline_count)
+    new_entries: Dict[str, List[str]] = {}
+    for event_number in range(timeline_count + 1, event_count + 1):
+        for name, entry in timeline_changes(next(events), event_number, state).items():
+            new_entries.setdefault(name, []).append(json.dumps(entry) + "\n")
+
+    os.makedirs(campaign.timeline_dir, exist_ok=True)
+    for name, lines in new_entries.items():
+        with open(timeline_path(name), "a") as f:
+            f.write("".join(lines))
+    write_file_atomically(timeline_index_path(), json.dumps({
+        "event_count": event_count,
+        "digest": digest,
+    }))
+    return event_count, {}
+
+
+################################################################################
+# read_timeline_index
+#
+# Returns how many of the event_count events the timeline index covers, using
+# digest to check that they are the events it was built from. If none of them
+# are, the old timeline files are removed so the index can be rebuilt.
+################################################################################
+def read_timeline_index(event_count: int, digest: Callable[[int], str]) -> int:
+    timeline_count = 0
+    if os.path.exists(timeline_index_path()):
+        with open(timeline_index_path(), "r") as f:
+            timeline_index = json.load(f)
+        if timeline_index["event_count"] <= event_count and timeline_index["digest"] == digest(timeline_index["event_count"]):
+            timeline_count = timeline_index["event_count"]
+
+    if timeline_count == 0 and timeline_count != event_count and os.path.isdir(campaign.timeline_dir):
+        for filename in os.listdir(campaign.timeline_dir):
+            os.remove(os.path.join(campaign.timeline_dir, filename))
+    return timeline_count
+
+
+timeline_event_descriptions = {
+    "newplayer": "Created",
+    "bonusexp": "Bonus exp",
+    "levelup": "Level up",
+    "sessionexp": "Session",
+    "removeplayer": "Removed",
+    "restoreplayer": "Restored",
+    "transfer": "Transfer",
+}
+
+
+################################################################################
+# list_player_timeline
+#
+# Prints every event that changed a player, with the exp they gained and the
+# exp and level they had afterwards.
+################################################################################
+def list_player_timeline(name: str) -> None:
+    event_count, timelines = update_timeline_index()
+    entries = timelines.get(name, []) if timelines else read_timeline(name, event_count)
+
+    if not entries:
+        print("No events found for {name}".format(name=name))
+        exit(1)
+
+    output_string = "Timeline for {name} ({count} events)".format(name=name, count=len(entries))
+    print(output_string)
+    print("="*len(output_string))
+
+    for entry in entries:
+        print("Event {event} {date} {description}: {exp_change:+}xp, {exp}xp total (Level {level}){removed}".format(
+            event=entry["event"],
+            date=entry["date"],
+            description=timeline_event_descriptions.get(entry["type"], entry["type"]),
+            exp_change=entry["exp_change"],
+            exp=entry["exp"],
+            level=get_level_from_exp(entry["exp"]),
+            removed=" [removed]" if entry["removed"] else "",
+        ))
+
+
+################################################################################
+# parse_party
+#
+# Reads a --party for the simulate command, a comma separated list of players
+# where a "q:" prefix marks a player who wrote a quest log and an "f:" prefix
+# marks a player who wrote a fast quest log.
+################################################################################
+def parse_party(party: str) -> Tuple[List[str], List[str], List[str]]:
+    players: List[str] = []
+    questlog_players: List[str] = []
+    fastlog_players: List[str] = []
+    for player in party.split(","):
+        player = player.strip()
+        if player.startswith("q:"):
+            questlog_players.append(player[2:].strip())
+        elif player.startswith("f:"):
+            fastlog_players.append(player[2:].strip())
+        elif player:
+            players.append(player)
+    return players, questlog_players, fastlog_players
+
+
+################################################################################
+# simulate_session
+#
+# Runs a session exp event against a clone of the state and returns what every
+# player in the session would end up with, leaving the original state as it
+# was. This runs in the worker processes of the simulate command.
+################################################################################
+def simulate_session(state: State, event: Any) -> Dict[str, Any]:
+    simulated_state = state.clone()
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_event(event, simulated_state, render=False)
+
+    session_players = event["players"] + event["questlog_players"] + event["fastlog_players"]
+    return {
+        "total_exp": session_total_exp(event, state),
+        "players": {
+            player: (state.players[player], simulated_state.players[player])
+            for player in session_players
+        },
+    }
+
+
+################################################################################
+# print_table
+#
+# Prints rows of cells with every column padded to its widest cell.
+################################################################################
+def print_table(rows: List[List[str]]) -> None:
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+################################################################################
+# simulate_sessions
+#
+# Previews every combination of candidate exp amounts and parties against the
+# current state without writing any events. Each scenario works on its own
+# clone of the state and rolls quest log gold from its own generator, so the
+# scenarios can run in parallel in a process pool and give the same results as
+# running them one at a time.
+################################################################################
+def simulate_sessions(
+    exp_amounts: List[str],
+    parties: List[Tuple[List[str], List[str], List[str]]],
+    jobs: Optional[int] = None,
+    state: Optional[State] = None,
+) -> None:
+    if state is None:
+        state, _ = replay_to()
+
+    date = datetime.datetime.now().strftime('%Y/%m/%d-%H:%M:%S')
+    events: List[Any] = []
+    for players, questlog_players, fastlog_players in parties:
+        for exp_gained in exp_amounts:
+            events.append({
+                "type": "sessionexp",
+                "exp_gained": exp_gained,
+                "players": players,
+                "questlog_players": questlog_players,
+                "fastlog_players": fastlog_players,
+                "date": date,
+            })
+
+    for event in events:
+        errors = event_errors(event, state)
+        if errors:
+            print("Cannot simulate {exp} for {players}: {errors}".format(
+                exp=event["exp_gained"],
+                players=", ".join(event["players"] + event["questlog_players"] + event["fastlog_players"]),
+                errors="; ".join(errors),
+            ))
+            exit(1)
+
+    if jobs == 1 or len(events) == 1:
+        results = [simulate_session(state, event) for event in events]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(simulate_session, itertools.repeat(state), events))
+
+    summary_rows = [["Scenario", "Exp", "Party", "Total Exp", "Gained Exp", "Level Ups"]]
+    for scenario, (event, result) in enumerate(zip(events, results), 1):
+        summary_rows.append([
+            str(scenario),
+            event["exp_gained"],
+            ", ".join(event["players"] + ["q:" + player for player in event["questlog_players"]] + ["f:" + player for player in event["fastlog_players"]]),
+            str(result["total_exp"]),
+            str(sum(after - before for before, after in result["players"].values())),
+            str(sum(get_level_from_exp(after) - get_level_from_exp(before) for before, after in result["players"].values())),
+        ])
+    print_table(summary_rows)
+    print("")
+
+    all_players = sorted(set(player for result in results for player in result["players"]))
+    player_rows = [["Player"] + ["Scenario {n}".format(n=n) for n in range(1, len(results) + 1)]]
+    for player in all_players:
+        row = [player]
+        for result in results:
+            if player not in result["players"]:
+                row.append("-")
+                continue
+            before, after = result["players"][player]
+            row.append("+{gained}xp (Level {level})".format(gained=after - before, level=get_level_from_exp(after)))
+        player_rows.append(row)
+    print_table(player_rows)
+
+
+################################################################################
+# show_last_update
+#
+# Prints the result of the most recent event, from the daemon's cache when the
+# command is being run by the daemon.
+################################################################################
+def show_last_update(cache: Optional["EventCache"]) -> None:
+    if cache is None:
+        list_previous_update()
+        return
+
+    cache.refresh()
+    print("\n".join(cache.last_update))
+
+
+################################################################################
+# EventCache
+#
+# Holds the state after every event in the event log for the daemon, along with
+# the output of the most recent event. New events appended to the log are
+# applied as they appear. If the log is replaced or shrinks, by the export
+# command for instance, the state is replayed again from the snapshots.
+################################################################################
+class EventCache:
+    def __init__(self) -> None:
+        self.state = State()
+        self.event_count = 0
+        self.last_update: List[str] = []
+        self._log_id: Optional[Tuple[int, int]] = None
+        self._log_offset = 0
+
+    def refresh(self) -> None:
+        if event_database_exists():
+            self._refresh_from_database()
+            return
+
+        if not os.path.exists(campaign.event_log_file):
+            migrate_event_source()
+
+        log_stat = os.stat(campaign.event_log_file)
+        log_id = (log_stat.st_dev, log_stat.st_ino)
+        if log_id != self._log_id or log_stat.st_size < self._log_offset:
+            self._rebuild(log_id)
+        elif log_stat.st_size > self._log_offset:
+            for event, offset in read_event_log_from(self._log_offset):
+                self._log_offset = offset
+                self._apply(event)
+
+    def invalidate(self) -> None:
+        self._log_id = None
+
+    def _rebuild(self, log_id: Tuple[int, int]) -> None:
+        self._log_id = log_id
+        self._log_offset = 0
+        self.last_update = []
+
+        self.event_count = max(count_events() - 1, 0)
+        self.state, _ = replay_to(self.event_count)
+
+        self._log_offset = event_log_offset(self.event_count)
+        for event, offset in read_event_log_from(self._log_offset):
+            self._log_offset = offset
+            self._apply(event)
+
+    # The database is only ever added to, so anything past the cached events is
+    # new. It is rebuilt if the database was replaced.
+    def _refresh_from_database(self) -> None:
+        database_stat = os.stat(campaign.event_database_file)
+        database_id = (database_stat.st_dev, database_stat.st_ino)
+        if database_id != self._log_id or count_events() < self.event_count:
+            self._log_id = database_id
+            self.last_update = []
+            self.event_count = max(count_events() - 1, 0)
+            self.state, _ = replay_to(self.event_count)
+
+        for event in read_database_events(self.event_count):
+            self._apply(event)
+
+    def _apply(self, event: Any) -> None:
+        self.event_count += 1
+
+        # Keep any warnings about the event with the rest of its output
+        warnings = io.StringIO()
+        with contextlib.redirect_stdout(warnings):
+            output_lines = process_event(event, self.state)
+
+        output_string = "Showing the result of event {n} of {total_count} events.".format(
+            n=self.event_count,
+            total_count=self.event_count)
+        self.last_update = [output_string, "="*len(output_string)] + warnings.getvalue().splitlines() + ["\n".join(output_lines)]
+
+
+################################################################################
+# run_daemon_command
+#
+# Runs a command sent to the daemon against its cache, returning everything the
+# command printed along with its exit status.
+################################################################################
+def run_daemon_command(parsed_args: argparse.Namespace, cache: EventCache) -> Tuple[str, int]:
+    output = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            cache.refresh()
+            run_command(parsed_args, cache)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+            # The failed command may have stopped part way through an event
+            # so the cached state can no longer be trusted.
+            cache.invalidate()
+    return output.getvalue(), status
+
+
+################################################################################
+# serve
+#
+# Runs the daemon on DAEMON_SOCKET_FILE until it is interrupted. Each request
+# is one line of json with the parsed command line arguments, and is answered
+# with one line of json with the output and exit status of the command.
+# Commands are run one at a time.
+################################################################################
+def serve() -> None:
+    if send_to_daemon(None) is not None:
+        print("A daemon is already running on {socket}".format(socket=campaign.daemon_socket_file))
+        exit(1)
+    if os.path.exists(campaign.daemon_socket_file):
+        os.remove(campaign.daemon_socket_file)
+
+    cache = EventCache()
+    cache.refresh()
+
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        request = json.loads(await reader.readline())
+        output, status = run_daemon_command(argparse.Namespace(**request["args"]), cache)
+        writer.write((json.dumps({"output": output, "status": status}) + "\n").encode("utf-8"))
+        await writer.drain()
+        writer.close()
+
+    async def run_server() -> None:
+        server = await asyncio.start_unix_server(handle_request, path=campaign.daemon_socket_file)
+
+        stopped = asyncio.Event()
+        for stop_signal in [signal.SIGINT, signal.SIGTERM]:
+            asyncio.get_running_loop().add_signal_handler(stop_signal, stopped.set)
+
+        async with server:
+            await stopped.wait()
+
+    print("Serving {count} events on {socket}".format(count=cache.event_count, socket=campaign.daemon_socket_file))
+    try:
+        asyncio.run(run_server())
+    finally:
+        if os.path.exists(campaign.daemon_socket_file):
+            os.remove(campaign.daemon_socket_file)
+
+
+################################################################################
+# send_to_daemon
+#
+# Sends the parsed command line arguments to a running daemon and prints its
+# output. Returns the exit status of the command, or None if there is no daemon
+# to send it to. With no arguments it only checks whether a daemon is listening.
+################################################################################
+def send_to_daemon(parsed_args: Optional[argparse.Namespace]) -> Optional[int]:
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(campaign.daemon_socket_file):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(campaign.daemon_socket_file)
+    except OSError:
+        connection.close()
+        return None
+
+    with connection:
+        if parsed_args is None:
+            return 0
+        connection.sendall((json.dumps({"args": vars(parsed_args)}) + "\n").encode("utf-8"))
+        response = json.loads(connection.makefile("rb").readline())
+
+    sys.stdout.write(response["output"])
+    status: int = response["status"]
+    return status
+
+
+################################################################################
+# absolute_path_arguments
+#
+# Makes the file and directory arguments of a command absolute, so that a
+# daemon running in another working directory uses the same files the command
+# would have used if it ran here.
+################################################################################
+def absolute_path_arguments(parsed_args: argparse.Namespace) -> argparse.Namespace:
+    if parsed_args.command == "import":
+        parsed_args.file = os.path.abspath(parsed_args.file)
+    elif parsed_args.command == "export" and parsed_args.output is not None:
+        parsed_args.output = os.path.abspath(parsed_args.output)
+    elif parsed_args.command == "campaigns" and parsed_args.add is not None:
+        name, directory = parsed_args.add
+        parsed_args.add = [name, os.path.abspath(directory)]
+    return parsed_args
+
+
 ################################################################################
 # Get a percentage of the total amount of EXP that would be required for each
 # player to level up if they were at the beginning of their respective level
@@ -418,28 +2875,41 @@ def get_party_level_percentage(state: State, players: List[str], percentage: int
     total_level_exp = 0
     for player in players:
         exp = state.players[player]
-        level = get_level_from_exp(exp)
+        total_level_exp += level_exp_deltas[get_level_from_exp(exp)]
 
-        level_exp = level_exp_caps[level] - level_exp_caps[level - 1]
+    return int(total_level_exp / 100 * percentage)
 
-        total_level_exp += level_exp
 
-    return int(total_level_exp / 100 * percentage)
+################################################################################
+# process_event
+#
+# Applies an event to the state and returns the text describing what happened.
+# Replays that only need the resulting state turn render off, which skips
+# building the text, and rolling the quest log gold that only appears in it,
+# and returns no lines. Warnings are printed either way.
+################################################################################
+def process_event(event: Any, state: State, render: bool = True) -> List[str]:
+    if profiler is not None:
+        with profiler.phase("process_{type}".format(type=event["type"])):
+            return process_event_by_type(event, state, render)
+    return process_event_by_type(event, state, render)
 
 
-def process_event(event: Any, state: State) -> List[str]:
+def process_event_by_type(event: Any, state: State, render: bool) -> List[str]:
     if event["type"] == "newplayer":
-        return process_new_player_event(event, state)
+        return process_new_player_event(event, state, render)
     elif event["type"] == "bonusexp":
-        return process_bonus_exp_event(event, state)
+        return process_bonus_exp_event(event, state, render)
     elif event["type"] == "levelup":
-        return process_levelup_event(event, state)
+        return process_levelup_event(event, state, render)
     elif event["type"] == "sessionexp":
-        return process_session_exp_event(event, state)
+        return process_session_exp_event(event, state, render)
     elif event["type"] == "removeplayer":
-        return process_remove_player_event(event, state)
+        return process_remove_player_event(event, state, render)
     elif event["type"] == "restoreplayer":
-        return process_restore_player_event(event, state)
+        return process_restore_player_event(event, state, render)
+    elif event["type"] == "transfer":
+        return process_transfer_event(event, state, render)
     else:
         print("ERROR: Invalid Event", event)
         return []
@@ -450,11 +2920,13 @@ def process_event(event: Any, state: State) -> List[str]:
 # this is not a valid event. If the player already exists the exp will be      #
 # overwritten by this event.                                                   #
 ################################################################################
-def process_new_player_event(event: Any, state: State) -> List[str]:
+def process_new_player_event(event: Any, state: State, render: bool = True) -> List[str]:
     if event["name"] in state.players:
         print("WARNING: Duplicate New Players", event)
 
-    state.players[event["name"]] = event["exp"]
+    state.set_player_exp(event["name"], event["exp"])
+    if not render:
+        return []
 
     return [
         "Created the new player {name} starting with {exp}xp (Level {level})".format(
@@ -466,12 +2938,14 @@ def process_new_player_event(event: Any, state: State) -> List[str]:
 
 
 ################################################################################
-def process_bonus_exp_event(event: Any, state: State) -> List[str]:
+def process_bonus_exp_event(event: Any, state: State, render: bool = True) -> List[str]:
     if event["name"] not in state.players:
         print("WARNING: Player not found for bonus", event)
         return []
 
-    state.players[event["name"]] += event["bonusexp"]
+    state.set_player_exp(event["name"], state.players[event["name"]] + event["bonusexp"])
+    if not render:
+        return []
     current_player_level = get_level_from_exp(state.players[event["name"]])
 
     return [
@@ -485,7 +2959,7 @@ def process_bonus_exp_event(event: Any, state: State) -> List[str]:
 
 
 ################################################################################
-def process_levelup_event(event: Any, state: State) -> List[str]:
+def process_levelup_event(event: Any, state: State, render: bool = True) -> List[str]:
     name = event["name"]
     level_change = event["levels"]
     preserve_percentage = event["preserve_percentage"]
@@ -508,7 +2982,9 @@ def process_levelup_event(event: Any, state: State) -> List[str]:
         return []
 
     gained_exp = exp_needed_for_bonus_levels(current_exp=current_exp, level_change=level_change, preserve=preserve_percentage)
-    state.players[name] += gained_exp
+    state.set_player_exp(name, state.players[name] + gained_exp)
+    if not render:
+        return []
 
     return [
         "{name} gained {levels} levels (from {gained_exp}exp). They are currently at Level {level}".format(
@@ -552,25 +3028,8 @@ def exp_needed_for_bonus_levels(current_exp: int, level_change: int = 1, preserv
 
     return (intended_level_min + preserved_exp) - current_exp
 
-def process_session_exp_event(event: Any, state: State) -> List[str]:
-    # Make sure random numbers are generate the same for this event
-    random.seed(event["date"])
-
-    exp_gain_chunks = event["exp_gained"].split("+")
-
-    total_exp = 0
-
-    for exp_gain_chunk in exp_gain_chunks:
-        if exp_gain_chunk.strip()[-1] == "%":
-            total_exp += get_party_level_percentage(
-                state,
-                event["players"] + event["questlog_players"] + event["fastlog_players"],
-                int(exp_gain_chunk.strip()[:-1])
-            )
-        else:
-            total_exp += int(exp_gain_chunk)
-
-
+def process_session_exp_event(event: Any, state: State, render: bool = True) -> List[str]:
+    total_exp = session_total_exp(event, state)
 
     players: List[LevelingUpPlayer] = []
 
@@ -591,7 +3050,6 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
                 name=player,
                 exp=state.players[player],
                 level=get_level_from_exp(state.players[player]),
-                quest_log_bonus_gold=bonus_gold_for_quest_log(player_level),
             )
         )
 
@@ -602,10 +3060,10 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
                 name=player,
                 exp=state.players[player],
                 level=player_level,
-                quest_log_bonus_gold=bonus_gold_for_quest_log(player_level),
                 should_get_quest_log_bonus_exp=True,
             )
         )
+    quest_log_players = players[len(event["players"]):]
 
     autolevel_threshold = get_level_from_exp(max(state.players.values(), key=get_level_from_exp)) - DESIRED_LEVEL_WINDOW
     autoleveled_players = [player for player in players if player.level < autolevel_threshold]
@@ -629,6 +3087,34 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
             player.gained_exp += quest_log_bonus_exp
             player.quest_log_bonus_exp = quest_log_bonus_exp
 
+    for player in players:
+        state.set_player_exp(player.name, player.exp + player.gained_exp)
+
+    if not render:
+        return []
+    return session_exp_output_lines(event, players, quest_log_players, autoleveled_players, total_exp, bonus_exp)
+
+
+################################################################################
+# session_exp_output_lines
+#
+# Describes the result of a session for each player. This is only called for
+# the sessions that are shown, which is also the only time the quest log gold
+# needs to be rolled.
+################################################################################
+def session_exp_output_lines(
+    event: Any,
+    players: List[LevelingUpPlayer],
+    quest_log_players: List[LevelingUpPlayer],
+    autoleveled_players: List[LevelingUpPlayer],
+    total_exp: int,
+    bonus_exp: float,
+) -> List[str]:
+    # Make sure random numbers are generate the same for this event
+    quest_log_gold = bonus_gold_for_quest_logs(event["date"], [player.level for player in quest_log_players])
+    for player, gold in zip(quest_log_players, quest_log_gold):
+        player.quest_log_bonus_gold = gold
+
     output_lines: List[str] = []
 
     for player in players:
@@ -660,7 +3146,7 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
                 current_level=player.level,
                 next_level=player.level+1,
                 remaining_exp_within_level=str(level_exp_caps[player.level] - (current_exp)),
-                total_level_exp=str(level_exp_caps[player.level] - level_exp_caps[player.level - 1]),
+                total_level_exp=str(level_exp_deltas[player.level]),
                 exp_within_level=str(current_exp - level_exp_caps[player.level - 1]),
             ))
 
@@ -684,12 +3170,29 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
         per_player=str(bonus_exp / len(players))
     ))
 
+    return output_lines
 
+################################################################################
+# session_total_exp
+#
+# Adds up the exp a session grants. Each "+" separated part of the exp is
+# either a number of exp or a percentage of the party's current levels.
+################################################################################
+def session_total_exp(event: Any, state: State) -> int:
+    total_exp = 0
 
-    for player in players:
-        state.players[player.name] = player.exp + player.gained_exp
+    for exp_gain_chunk in event["exp_gained"].split("+"):
+        if exp_gain_chunk.strip()[-1] == "%":
+            total_exp += get_party_level_percentage(
+                state,
+                event["players"] + event["questlog_players"] + event["fastlog_players"],
+                int(exp_gain_chunk.strip()[:-1])
+            )
+        else:
+            total_exp += int(exp_gain_chunk)
+
+    return total_exp
 
-    return output_lines
 
 ################################################################################
 # bonus_exp_for_quest_log
@@ -697,19 +3200,39 @@ def process_session_exp_event(event: Any, state: State) -> List[str]:
 # Calculates the 5% exp bonus for a character at a given level.
 ################################################################################
 def bonus_exp_for_quest_log(level: int) -> int:
-    delta = level_exp_caps[level] - level_exp_caps[level - 1]
-    return int(math.ceil(delta * .05))
+    return quest_log_bonus_exps[level]
+
+
+quest_log_bonus_exps: List[int] = [int(math.ceil(level_exp_delta * .05)) for level_exp_delta in level_exp_deltas]
+
+
+################################################################################
+# bonus_gold_for_quest_logs
+#
+# Calculates the random amount of gold each character will receive for writing
+# a quest log, given the levels of the characters in the order they are listed
+# in the session.
+################################################################################
+def bonus_gold_for_quest_logs(date: str, levels: List[int]) -> List[int]:
+    rolls = quest_log_gold_rolls(date, tuple(quest_log_gold_map[level - 1]["dice_size"] for level in levels))
+    return [roll * quest_log_gold_map[level - 1]["multiplier"] for roll, level in zip(rolls, levels)]
 
 
 ################################################################################
-# bonus_gold_for_quest_log
+# quest_log_gold_rolls
 #
-# Calculates the random amount of gold a character will receive for writing
-# a quest log within the time limit.
+# Rolls each of the dice, in order, from a generator seeded with the date of
+# the session, which gives the same rolls the session has always had. The
+# generator belongs to the session so nothing else can change its rolls, and
+# since the rolls only depend on the date and the dice they are cached, so
+# replaying a session again in the same process does not reseed a generator.
 ################################################################################
-def bonus_gold_for_quest_log(level: int) -> int:
-    roll = random.randint(1, quest_log_gold_map[level - 1]["dice_size"])
-    return roll * quest_log_gold_map[level - 1]["multiplier"]
+@functools.lru_cache(maxsize=4096)
+def quest_log_gold_rolls(date: str, dice_sizes: Tuple[int, ...]) -> Tuple[int, ...]:
+    if not dice_sizes:
+        return ()
+    rng = random.Random(date)
+    return tuple(rng.randint(1, dice_size) for dice_size in dice_sizes)
 
 
 ################################################################################
@@ -721,7 +3244,7 @@ def bonus_gold_for_quest_log(level: int) -> int:
 def remaining_exp_string(current_level: int, current_exp: int) -> str:
     return "{exp_within_level}/{total_level_exp}xp through level {current_level} ({remaining_exp_within_level}xp remaining)".format(
         exp_within_level=str(current_exp - level_exp_caps[current_level - 1]),
-        total_level_exp=str(level_exp_caps[current_level] - level_exp_caps[current_level - 1]),
+        total_level_exp=str(level_exp_deltas[current_level]),
         current_level=current_level,
         remaining_exp_within_level=str(level_exp_caps[current_level] - (current_exp)),
     )
@@ -732,48 +3255,49 @@ def remaining_exp_string(current_level: int, current_exp: int) -> str:
 #
 # Injects the divided exp into each of the player objects. See
 # adjusted_player_award() for more info on how exp is divided.
+#
+# The exp is handed out in rounds. Any player pushed past the end of their level
+# is capped at the start of the next level and the exp beyond that is divided
+# again between the players who have not leveled up yet. The rounds run in
+# exactly the same order as they always have so the floating point results,
+# and therefore the rounded awards, do not change.
 ################################################################################
-def divide_exp(total_exp: int, players: List[LevelingUpPlayer]) -> Any:
-    if (total_exp == 0):
+def divide_exp(total_exp: float, players: List[LevelingUpPlayer]) -> Any:
+    awards: List[float] = []
+    if players:
+        max_player_level = max([player.level for player in players])
+        awards = [adjusted_player_award(max_player_level, player.level) for player in players]
+
+    rounds = 0
+    while total_exp != 0:
+        rounds += 1
+        open_players = [
+            (player, award) for player, award in zip(players, awards)
+            if not player.leveled_up
+        ]
+        if not open_players:
+            break
+
+        total_player_slices = sum(award for _, award in open_players)
+        for player, award in open_players:
+            player.gained_exp += total_exp * award / total_player_slices
+
+        total_exp = 0
+        for player, _ in open_players:
+            next_level_exp = level_exp_caps[player.level]
+            if player.level < MAX_LEVEL and math.ceil(player.exp + player.gained_exp) >= next_level_exp:
+                player.leveled_up = True
+                total_exp += player.exp + player.gained_exp - next_level_exp
+                player.gained_exp = next_level_exp - player.exp
+    else:
         for player in players:
             player.gained_exp = math.ceil(player.gained_exp)
 
-        return players
-
-    if all(player.leveled_up for player in players):
-        return players
-
-    max_player_level = max([player.level for player in players])
-
-    total_player_slices = sum([adjusted_player_award(max_player_level, player.level) for player in players if not player.leveled_up])
-    for player in players:
-        if player.leveled_up:
-            continue
-        adjusted_award = adjusted_player_award(max_player_level, player.level)
-        player.gained_exp += total_exp * adjusted_award / total_player_slices
-
-    total_leftover_exp = 0
-
-    for player in players:
-        if player.level < get_level_from_exp(math.ceil(player.exp + player.gained_exp)):
-            player.leveled_up = True
-            leftover_exp = player.exp + player.gained_exp - level_exp_caps[player.level]
-            player.gained_exp = level_exp_caps[player.level] - player.exp
-            total_leftover_exp += leftover_exp
-
-    return divide_exp(total_leftover_exp, players)
-
+    if profiler is not None:
+        profiler.count("divide_exp_rounds", rounds)
+        profiler.maximum("divide_exp_max_rounds", rounds)
 
-################################################################################
-# get_level_from_exp
-#
-# Calculate what level someone would be given the amount of exp they have.
-################################################################################
-def get_level_from_exp(exp: int) -> int:
-    for i, level_exp_cap in enumerate(level_exp_caps):
-        if exp < level_exp_cap:
-            return i
-    return MAX_LEVEL
+    return players
 
 
 ################################################################################
@@ -785,7 +3309,12 @@ def get_level_from_exp(exp: int) -> int:
 # the pool.
 ################################################################################
 def adjusted_player_award(max_player_level: int, player_level: int) -> float:
-    return math.pow(math.sqrt(2), max_player_level - player_level)
+    return adjusted_player_award_powers[max_player_level - player_level]
+
+
+# The shares for every possible difference in level, computed the same way as
+# they always have been so the awards do not change.
+adjusted_player_award_powers: List[float] = [math.pow(math.sqrt(2), level_difference) for level_difference in range(MAX_LEVEL + 1)]
 
 
 # Note some of these have different heights from each other in discord's
@@ -825,7 +3354,7 @@ def percentage_bar(percentage: float, characters: int) -> str:
 
 
 
-def process_remove_player_event(event: Any, state: State) -> List[str]:
+def process_remove_player_event(event: Any, state: State, render: bool = True) -> List[str]:
     if event["name"] not in state.players:
         print("WARNING: Player not found for removal.", event)
         return []
@@ -834,8 +3363,9 @@ def process_remove_player_event(event: Any, state: State) -> List[str]:
         print("WARNING: Player is already in removed players", event)
         return[]
 
-    state.removed_players[event["name"]] = state.players[event["name"]]
-    del state.players[event["name"]]
+    state.remove_player(event["name"])
+    if not render:
+        return []
 
     return [
         "Removed {name}".format(
@@ -844,7 +3374,7 @@ def process_remove_player_event(event: Any, state: State) -> List[str]:
     ]
 
 
-def process_restore_player_event(event: Any, state: State) -> List[str]:
+def process_restore_player_event(event: Any, state: State, render: bool = True) -> List[str]:
     if event["name"] not in state.removed_players:
         print("WARNING: Player not found for restoration.", event)
         return []
@@ -853,8 +3383,9 @@ def process_restore_player_event(event: Any, state: State) -> List[str]:
         print("WARNING: Player is already a player", event)
         return[]
 
-    state.players[event["name"]] = state.removed_players[event["name"]]
-    del state.removed_players[event["name"]]
+    state.restore_player(event["name"])
+    if not render:
+        return []
 
     return [
         "Restored {name}".format(
@@ -863,5 +3394,57 @@ def process_restore_player_event(event: Any, state: State) -> List[str]:
     ]
 
 
+################################################################################
+# process_transfer_event
+#
+# Gives the receiver half of the donor's exp, scaled so that it is worth the
+# same at the receiver's level as it was at the donor's, the same way
+# transfer_exp.py does. The donor keeps their exp and can be a removed player,
+# and is removed once their exp is given if the event retires them. Each
+# player can only give their exp once, so the donor is recorded in the state.
+################################################################################
+def process_transfer_event(event: Any, state: State, render: bool = True) -> List[str]:
+    donor_exp = player_exp(state, event["donor"])
+    if donor_exp is None:
+        print("WARNING: Donor not found for transfer", event)
+        return []
+
+    if event["receiver"] not in state.players:
+        print("WARNING: Receiver not found for transfer", event)
+        return []
+
+    if event["donor"] == event["receiver"]:
+        print("WARNING: Player cannot transfer exp to themselves", event)
+        return []
+
+    if event["donor"] in state.donors:
+        print("WARNING: Donor has already given their exp", event)
+        return []
+
+    receiver_exp = state.players[event["receiver"]]
+    state.set_player_exp(event["receiver"], transfer_scaled_exp(donor_exp, receiver_exp))
+    state.add_donor(event["donor"])
+
+    retired = event["retire_donor"] and event["donor"] in state.players
+    if retired:
+        state.remove_player(event["donor"])
+    if not render:
+        return []
+
+    output_lines = [
+        "{receiver} received {exp}xp from {donor}'s {donor_exp}xp (Level {donor_level}). They are currently at Level {level}".format(
+            receiver=event["receiver"],
+            exp=state.players[event["receiver"]] - receiver_exp,
+            donor=event["donor"],
+            donor_exp=donor_exp,
+            donor_level=get_level_from_exp(donor_exp),
+            level=get_level_from_exp(state.players[event["receiver"]]),
+        )
+    ]
+    if retired:
+        output_lines.append("Removed {donor}".format(donor=event["donor"]))
+    return output_lines
+
+
 if __name__ == "__main__":
     main()
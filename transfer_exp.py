@@ -1,36 +1,24 @@
 import math
+import os
+import glob
+import json
+import hashlib
+import functools
+import contextlib
+import itertools
+import csv
+import sys
 import numpy as np
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, TextIO
 from PIL import Image
 import argparse
+import numpy.typing as npt
+from level_table import level_exp_caps, scaled_exp_caps, level_scalings, get_level_from_exp, get_level_from_scaled_exp
+from level_table import to_scaled_exp, from_scaled_exp
+from level_table import get_levels_from_exp_array, get_levels_from_scaled_exp_array
 
-level_xp_caps =  [
-    0,      # Level Start 1
-    300,    # Level Start 2
-    900,    # Level Start 3
-    2700,   # Level Start 4
-    6500,   # Level Start 5
-    14000,  # Level Start 6
-    23000,  # Level Start 7
-    34000,  # Level Start 8
-    48000,  # Level Start 9
-    64000,  # Level Start 10
-    85000,  # Level Start 11
-    100000, # Level Start 12
-    120000, # Level Start 13
-    140000, # Level Start 14
-    165000, # Level Start 15
-    195000, # Level Start 16
-    225000, # Level Start 17
-    265000, # Level Start 18
-    305000, # Level Start 19
-    355000, # Level Start 20 
-    355000, # upper bound threshold at level 20, repeated for index delta convienience
-]
-
-
-def scaling(source_player_level: int, target_player_level: int) -> float:
-    return math.pow(math.sqrt(2), source_player_level-target_player_level)
+level_xp_caps = level_exp_caps
+scaled_xp_caps = scaled_exp_caps
 
 # def xp_remaining_in_level(input_xp: int) -> int:
 #   level = level_from_xp(input_xp)
@@ -38,14 +26,9 @@ def scaling(source_player_level: int, target_player_level: int) -> float:
 #   return level_xp_caps[level] - input_xp
 
 def level_from_xp(xp: int) -> int:
-    for i, level_xp_cap in enumerate(level_xp_caps):
-        if xp < level_xp_cap:
-            return i
-    if xp == level_xp_caps[-1]:
-        return 20
-
-    print("Error, more xp then possible", xp)
-    return 20
+    if xp > level_xp_caps[-1]:
+        print("Error, more xp then possible", xp)
+    return get_level_from_exp(xp)
 
 
 
@@ -55,11 +38,25 @@ def main():
 
     parser = argparse.ArgumentParser(description="Transfer Scaled XP Between Players")
 
-    parser.add_argument('-d', '--donor', metavar="xp", type=int, action='extend', nargs="+", help="A source of XP to be given to the receiver", required=True)
-    parser.add_argument('-r', '--receiver', metavar="xp", type=int, help="The XP the receiver already has", required=True)
+    parser.add_argument('-d', '--donor', metavar="xp", type=int, action='extend', nargs="+", help="A source of XP to be given to the receiver")
+    parser.add_argument('-r', '--receiver', metavar="xp", type=int, help="The XP the receiver already has")
+    parser.add_argument('--table', action='store_true', help="Read scaled XP from a precomputed table, generating it if the level caps have changed")
+    parser.add_argument('--batch', metavar="file", type=str, help="A .csv or .jsonl file of transfers to run instead of --donor and --receiver")
+    parser.add_argument('--output', metavar="file", type=str, default="-", help="The .csv or .jsonl file to write the batch results to, jsonl to stdout by default")
+    parser.add_argument('--events', metavar="file", type=str, help="A .jsonl file to write a bonusexp event for each batch transfer to, for sunholmexp.py import")
 
     parsed_args = parser.parse_args()
 
+    if parsed_args.batch is not None:
+        run_batch(parsed_args.batch, parsed_args.output, parsed_args.events)
+        return
+
+    if parsed_args.donor is None or parsed_args.receiver is None:
+        parser.error("--donor and --receiver are required without --batch")
+
+    if parsed_args.table:
+        use_scaled_xp_table()
+
 
     receiver_xp = parsed_args.receiver
 
@@ -79,7 +76,7 @@ def main():
 
 
 def gift(donor_xp, receiver_xp, donor_index=None):
-    new_xp = transfer_xp_scaled_level_range(donor_xp, receiver_xp)
+    new_xp = cached_transfer_xp_scaled_level_range(donor_xp, receiver_xp)
 
 
     if donor_index is None:
@@ -98,74 +95,143 @@ def gift(donor_xp, receiver_xp, donor_index=None):
 
     return new_xp
 
-# Build the scaled xp cap list
-scaled_xp_caps = [0]
-for i in range(19):
-    original_xp_required = level_xp_caps[i+1] - level_xp_caps[i]
-    scaling_value = scaling(i+1, 1)
-    scaled_xp_required = math.floor(original_xp_required * scaling_value)
-    scaled_xp_caps.append(scaled_xp_caps[-1] + scaled_xp_required)
-scaled_xp_caps.append(scaled_xp_caps[-1])
+################################################################################
+# to_scaled_xp
+#
+# level_table.to_scaled_exp and from_scaled_exp, warning when the xp is past
+# the max. sunholmexp.py uses the level_table versions to replay transfers.
+################################################################################
+def to_scaled_xp(xp: int) -> float:
+    level_from_xp(xp)
+    return to_scaled_exp(xp)
 
 
-def to_scaled_xp(xp: int) -> int:
-    # scale each level chunk by chunk
-    # We can probably lookup the scaled whole-level values then just scale the current level
+def get_level_from_scaled_xp(scaled_xp: float) -> int:
+    if scaled_xp > scaled_xp_caps[-1]:
+        print("Error, more scaled xp then possible", scaled_xp)
+    return get_level_from_scaled_exp(scaled_xp)
 
-    level = level_from_xp(xp)
-    gained_xp_in_level = xp - level_xp_caps[level-1]
+def from_scaled_xp(scaled_xp: float) -> int:
+    get_level_from_scaled_xp(scaled_xp)
+    return from_scaled_exp(scaled_xp)
 
-    scaling_value = scaling(level, 1)
 
-    scaled_xp_in_level = scaling_value * gained_xp_in_level
+# check_transfer_exp.py checks that every xp value scales monotonically and
+# survives a round trip through from_scaled_xp(to_scaled_xp(xp)).
 
-    # print(level, scaling_value, gained_xp_in_level, scaled_xp_caps[level-1])
 
-    return scaled_xp_in_level + scaled_xp_caps[level-1]
+################################################################################
+# Array Versions
+#
+# NumPy versions of to_scaled_xp, from_scaled_xp, and
+# transfer_xp_scaled_level_range that work on whole arrays of xp at once. They
+# do the same float64 operations in the same order as the scalar versions, and
+# np.round rounds halves to even like round() does, so every element comes out
+# identical to calling the scalar version on it.
+################################################################################
+level_xp_caps_array = np.array(level_xp_caps, dtype=np.int64)
+scaled_xp_caps_array = np.array(scaled_xp_caps, dtype=np.int64)
+level_scaling_array = np.array(level_scalings, dtype=np.float64)
 
 
+def to_scaled_xp_array(xp: npt.ArrayLike) -> npt.NDArray[np.float64]:
+    xp = np.asarray(xp, dtype=np.int64)
+    level = get_levels_from_exp_array(xp)
+    gained_xp_in_level = xp - level_xp_caps_array[level - 1]
 
-def get_level_from_scaled_xp(scaled_xp: int) -> int:
-    for i, level_xp_cap in enumerate(scaled_xp_caps):
-        if scaled_xp < level_xp_cap:
-            return i
-    if scaled_xp == scaled_xp_caps[-1]:
-        return 20
+    scaled_xp: npt.NDArray[np.float64] = level_scaling_array[level] * gained_xp_in_level + scaled_xp_caps_array[level - 1]
+    return scaled_xp
 
-    print("Error, more scaled xp then possible", scaled_xp)
-    return 20
 
-def from_scaled_xp(scaled_xp: int) -> int:
+def from_scaled_xp_array(scaled_xp: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    scaled_xp = np.asarray(scaled_xp)
+    level = get_levels_from_scaled_exp_array(scaled_xp)
 
-    level = get_level_from_scaled_xp(scaled_xp)
+    scaled_xp_in_level = scaled_xp - scaled_xp_caps_array[level - 1]
+    xp = np.round(scaled_xp_in_level / level_scaling_array[level]).astype(np.int64)
 
-    scaling_value = scaling(level, 1)
-    scaled_xp_in_level = scaled_xp - scaled_xp_caps[level-1]
+    result: npt.NDArray[np.int64] = level_xp_caps_array[level - 1] + xp
+    return result
 
-    xp = int(round(scaled_xp_in_level / scaling_value))
 
-    return level_xp_caps[level-1] + xp
+def transfer_xp_scaled_level_range_array(source_xp: npt.ArrayLike, target_xp: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    source_xp, target_xp = np.broadcast_arrays(np.asarray(source_xp, dtype=np.int64), np.asarray(target_xp, dtype=np.int64))
+
+    scaled_source = np.floor(to_scaled_xp_array(np.maximum(source_xp, 0)) * .5).astype(np.int64)
+    scaled_target = to_scaled_xp_array(target_xp)
+
+    total_scaled_xp = np.minimum(scaled_source + scaled_target, scaled_xp_caps[-1])
+
+    result: npt.NDArray[np.int64] = np.where(source_xp <= 0, target_xp, from_scaled_xp_array(total_scaled_xp))
+    return result
+
+
+################################################################################
+# Scaled XP Table
+#
+# All xp is a whole number from 0 to the max xp, so to_scaled_xp can be worked
+# out ahead of time for every value and read back out of a memory mapped .npy
+# file. The file name holds a digest of the caps and scaling, so a new table is
+# only generated when they change. from_scaled_xp is not tabled because the
+# scaled xp it is given is usually not a whole number.
+################################################################################
+SCALED_XP_TABLE_FILE = "transfer_exp.{digest}.npy"
+TRANSFER_CACHE_SIZE = 65536
 
-# last_scaled_i = 0
-# for i in range(355000):
-#   scaled_i = to_scaled_xp(i)
-#   if last_scaled_i > scaled_i:
-#       print("Invalid Scale", i, scaled_i, last_scaled_i)
-#       last_scaled_i = scaled_i
-#   if i != from_scaled_xp(scaled_i):
-#       print("Failure", i, from_scaled_xp(scaled_i))
-#       exit(1)
-# print("No error!")
+scaled_xp_table: Optional[npt.NDArray[np.float64]] = None
 
 
+def scaled_xp_table_digest() -> str:
+    caps = json.dumps([level_xp_caps, scaled_xp_caps, level_scaling_array.tolist()])
+    return hashlib.sha256(caps.encode("utf-8")).hexdigest()[:16]
+
+
+################################################################################
+# load_scaled_xp_table
+#
+# Memory maps the scaled xp table in the directory, generating it first if
+# there is no table for the current caps. Tables for old caps are removed.
+################################################################################
+def load_scaled_xp_table(directory: str = "") -> npt.NDArray[np.float64]:
+    path = os.path.join(directory, SCALED_XP_TABLE_FILE.format(digest=scaled_xp_table_digest()))
+
+    if not os.path.exists(path):
+        for stale_path in glob.glob(os.path.join(directory, SCALED_XP_TABLE_FILE.format(digest="*"))):
+            os.remove(stale_path)
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            np.save(f, to_scaled_xp_array(np.arange(level_xp_caps[-1] + 1)))
+        os.replace(temporary_path, path)
+
+    table: npt.NDArray[np.float64] = np.load(path, mmap_mode="r")
+    return table
+
+
+def use_scaled_xp_table(directory: str = "") -> None:
+    global scaled_xp_table
+    scaled_xp_table = load_scaled_xp_table(directory)
+
+
+################################################################################
+# lookup_scaled_xp
+#
+# to_scaled_xp, read from the scaled xp table when one is in use. Values the
+# table does not cover fall back to to_scaled_xp.
+################################################################################
+def lookup_scaled_xp(xp: int) -> float:
+    if scaled_xp_table is None or not 0 <= xp < len(scaled_xp_table):
+        return to_scaled_xp(xp)
+    return float(scaled_xp_table[xp])
+
 
 def transfer_xp_scaled_level_range(source_xp: int, target_xp: int) -> int:
 
     if source_xp <= 0:
         return target_xp
 
-    scaled_source = to_scaled_xp(source_xp)
-    scaled_target = to_scaled_xp(target_xp)
+    scaled_source = lookup_scaled_xp(source_xp)
+    scaled_target = lookup_scaled_xp(target_xp)
 
     scaled_source = int(math.floor(scaled_source * .5))
 
@@ -178,6 +244,162 @@ def transfer_xp_scaled_level_range(source_xp: int, target_xp: int) -> int:
     return from_scaled_xp(total_scaled_xp)
 
 
+################################################################################
+# cached_transfer_xp_scaled_level_range
+#
+# transfer_xp_scaled_level_range only depends on its two xp values, so repeated
+# transfers between the same xp are remembered instead of worked out again.
+################################################################################
+@functools.lru_cache(maxsize=TRANSFER_CACHE_SIZE)
+def cached_transfer_xp_scaled_level_range(source_xp: int, target_xp: int) -> int:
+    return transfer_xp_scaled_level_range(source_xp, target_xp)
+
+
+################################################################################
+# Batch Transfers
+#
+# A batch file lists transfers with a receiver, the receiver's xp and a donor's
+# xp, and optionally the donor's name. A transfer without receiver_xp chains on
+# from the transfer before it, giving the same receiver another donor's xp the
+# way multiple --donor values do. In jsonl donor_xp can also be a list of xp to
+# chain. The batch is read, transferred, and written a block at a time.
+################################################################################
+BATCH_BLOCK_SIZE = 1024
+
+batch_output_fields = ["receiver", "donor", "donor_xp", "receiver_xp", "new_receiver_xp", "gained_xp", "new_level"]
+
+
+def batch_file_format(path: str) -> str:
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def parse_optional_xp(value: Any) -> Optional[int]:
+    if value is None or str(value).strip() == "":
+        return None
+    return int(value)
+
+
+################################################################################
+# read_batch_transfers
+#
+# Reads the transfers from a batch file one at a time, splitting jsonl lists of
+# donor xp into one chained transfer per donor.
+################################################################################
+def read_batch_transfers(f: TextIO, file_format: str) -> Iterator[Dict[str, Any]]:
+    rows: Iterator[Dict[str, Any]]
+    if file_format == "csv":
+        rows = csv.DictReader(f)
+    else:
+        rows = (json.loads(line) for line in f if line.strip())
+
+    for row in rows:
+        donor_xps = row.get("donor_xp")
+        if not isinstance(donor_xps, list):
+            donor_xps = [donor_xps]
+
+        receiver_xp = parse_optional_xp(row.get("receiver_xp"))
+        for donor_xp in donor_xps:
+            yield {
+                "receiver": row.get("receiver") or "",
+                "donor": row.get("donor") or "",
+                "donor_xp": int(donor_xp),
+                "receiver_xp": receiver_xp,
+            }
+            receiver_xp = None
+
+
+################################################################################
+# transfer_batch_block
+#
+# Fills in the receiver_xp and results of a block of transfers. Each chain of
+# transfers is a row of donor xp, padded with 0 xp donors which transfer
+# nothing, and the chains all take their next donor at once. previous is the
+# last transfer of the block before, which the first chain may continue.
+################################################################################
+def transfer_batch_block(transfers: List[Dict[str, Any]], previous: Optional[Dict[str, Any]]) -> None:
+    chains: List[List[Dict[str, Any]]] = []
+    start_xps: List[int] = []
+    for transfer in transfers:
+        if transfer["receiver_xp"] is not None:
+            chains.append([transfer])
+            start_xps.append(transfer["receiver_xp"])
+            continue
+
+        chain_previous = chains[-1][-1] if chains else previous
+        if chain_previous is None or chain_previous["receiver"] != transfer["receiver"]:
+            raise ValueError("Transfer to {receiver} has no receiver_xp and does not follow a transfer to them".format(receiver=transfer["receiver"]))
+        if chains:
+            chains[-1].append(transfer)
+        else:
+            chains.append([transfer])
+            start_xps.append(chain_previous["new_receiver_xp"])
+
+    donor_xps = np.zeros((len(chains), max(len(chain) for chain in chains)), dtype=np.int64)
+    for i, chain in enumerate(chains):
+        donor_xps[i, :len(chain)] = [transfer["donor_xp"] for transfer in chain]
+
+    receiver_xps = np.empty_like(donor_xps)
+    new_receiver_xps = np.empty_like(donor_xps)
+    xp = np.array(start_xps, dtype=np.int64)
+    for step in range(donor_xps.shape[1]):
+        receiver_xps[:, step] = xp
+        xp = transfer_xp_scaled_level_range_array(donor_xps[:, step], xp)
+        new_receiver_xps[:, step] = xp
+
+    new_levels = get_levels_from_exp_array(new_receiver_xps)
+    for i, chain in enumerate(chains):
+        for step, transfer in enumerate(chain):
+            transfer["receiver_xp"] = int(receiver_xps[i, step])
+            transfer["new_receiver_xp"] = int(new_receiver_xps[i, step])
+            transfer["gained_xp"] = transfer["new_receiver_xp"] - transfer["receiver_xp"]
+            transfer["new_level"] = int(new_levels[i, step])
+
+
+################################################################################
+# run_batch
+#
+# Runs every transfer in the input file and writes the results, and optionally
+# the bonusexp events that would give each receiver their gained xp.
+################################################################################
+def run_batch(input_path: str, output_path: str, events_path: Optional[str]) -> None:
+    with contextlib.ExitStack() as stack:
+        input_file = stack.enter_context(open(input_path, "r", newline=""))
+        output_file = sys.stdout if output_path == "-" else stack.enter_context(open(output_path, "w", newline=""))
+        events_file = None if events_path is None else stack.enter_context(open(events_path, "w"))
+
+        output_format = batch_file_format(output_path)
+        csv_writer = csv.DictWriter(output_file, fieldnames=batch_output_fields)
+        if output_format == "csv":
+            csv_writer.writeheader()
+
+        transfers = read_batch_transfers(input_file, batch_file_format(input_path))
+        previous: Optional[Dict[str, Any]] = None
+        transfer_count = 0
+        for block in iter(lambda: list(itertools.islice(transfers, BATCH_BLOCK_SIZE)), []):
+            try:
+                transfer_batch_block(block, previous)
+            except ValueError as e:
+                print("Error,", e, file=sys.stderr)
+                exit(1)
+            previous = block[-1]
+            transfer_count += len(block)
+
+            for transfer in block:
+                if output_format == "csv":
+                    csv_writer.writerow(transfer)
+                else:
+                    output_file.write(json.dumps(transfer) + "\n")
+
+                if events_file is not None and transfer["gained_xp"] != 0:
+                    events_file.write(json.dumps({
+                        "type": "bonusexp",
+                        "name": transfer["receiver"],
+                        "bonusexp": transfer["gained_xp"],
+                    }) + "\n")
+
+    print("Transferred xp for {count} donors".format(count=transfer_count), file=sys.stderr)
+
+
 
 ################################################################################
 ################################################################################
@@ -198,12 +420,8 @@ def tenth_level_segments():
 def tests(array_2d):
 
     # Generate a grid of test case input values 
-    array_2d = []
-    for xp_a in tenth_level_segments():
-        row = []
-        for xp_b in tenth_level_segments():
-            row.append(transfer_xp_scaled_level_range(xp_a, xp_b))
-        array_2d.append(row)
+    segments = np.array(tenth_level_segments())
+    array_2d = transfer_xp_scaled_level_range_array(segments[:, np.newaxis], segments[np.newaxis, :]).tolist()
 
     print(array_2d)
     write_csv(array_2d, "testcsv.csv")